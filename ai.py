@@ -1,44 +1,129 @@
 import os
-import qdrant_client
-from typing import List
+import copy
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, List, Optional
 from langchain import OpenAI, ConversationChain
-from langchain.memory import ConversationSummaryBufferMemory
+from langchain.callbacks.base import BaseCallbackHandler, CallbackManager
+from langchain.llms.base import BaseLLM
 from langchain.document_loaders.sitemap import SitemapLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.schema import Document
-from langchain.vectorstores import Qdrant
-from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.chains.qa_with_sources import load_qa_with_sources_chain
-from scraper import Scraper
+from langchain.schema import Document
+from knowledge_base import KnowledgeBase, KnowledgeBaseRegistry, VectorClient, knowledge_bases
+from answer_cache import AnswerCache
+from settings import AnswerCacheSettings, CrawlSettings, EmbeddingSettings, RetrievalSettings, StoreSettings
+from memory import MemoryListener, SessionMemory
+from retrieval import Candidate, ContextPacker, model_token_budget, reciprocal_rank_fusion
+from lexical_index import is_keyword_query
+from tracing import tracer
 import nest_asyncio
 nest_asyncio.apply()
 
 
+class TokenStreamHandler(BaseCallbackHandler):
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__on_token: Optional[Callable[[str], None]] = None
+
+    @property
+    def always_verbose(self) -> bool:
+        return True
+
+    @contextmanager
+    def stream_to(self, on_token: Optional[Callable[[str], None]]):
+        # one query at a time per engine, so a single sink is enough
+        with self.__lock:
+            self.__on_token = on_token
+            try:
+                yield
+            finally:
+                self.__on_token = None
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> Any:
+        tracer.count("llm.streamed_tokens")
+        if self.__on_token is not None:
+            self.__on_token(token)
+
+    def on_llm_start(self, serialized, prompts, **kwargs: Any) -> Any:
+        pass
+
+    def on_llm_end(self, response, **kwargs: Any) -> Any:
+        pass
+
+    def on_llm_error(self, error, **kwargs: Any) -> Any:
+        pass
+
+    def on_chain_start(self, serialized, inputs, **kwargs: Any) -> Any:
+        pass
+
+    def on_chain_end(self, outputs, **kwargs: Any) -> Any:
+        pass
+
+    def on_chain_error(self, error, **kwargs: Any) -> Any:
+        pass
+
+    def on_tool_start(self, serialized, input_str, **kwargs: Any) -> Any:
+        pass
+
+    def on_tool_end(self, output, **kwargs: Any) -> Any:
+        pass
+
+    def on_tool_error(self, error, **kwargs: Any) -> Any:
+        pass
+
+    def on_text(self, text, **kwargs: Any) -> Any:
+        pass
+
+    def on_agent_action(self, action, **kwargs: Any) -> Any:
+        pass
+
+    def on_agent_finish(self, finish, **kwargs: Any) -> Any:
+        pass
+
+
 class OpenAIChat:
-    def __init__(self, model_name: str, api_key, temp=0.7, conversation_buffer_token_limit=1000):
+    def __init__(self, model_name: str, api_key, temp=0.7, conversation_buffer_token_limit=1000,
+                 llm_factory: Callable[..., BaseLLM] = OpenAI):
         self.__model_name = model_name
         self.__temperature = temp
         self._api_key = api_key
         self.__conversation_buffer_token_limit = conversation_buffer_token_limit
+        self._stream_handler = TokenStreamHandler()
+        self.__memory_listener = None
+        # called with the OpenAI constructor arguments; benchmarks plug in a fake llm here
+        self.__create_llm = llm_factory
 
         self.__llm_factory()
 
     def __llm_factory(self):
-        self._llm = OpenAI(temperature=self.__temperature,
-                           openai_api_key=self._api_key,
-                           model_name=self.__model_name)
+        self._llm = self.__create_llm(temperature=self.__temperature,
+                                      openai_api_key=self._api_key,
+                                      model_name=self.__model_name,
+                                      streaming=True,
+                                      callback_manager=CallbackManager([self._stream_handler]))
+
+        # summaries are internal, so they come from a separate llm that never streams into the reply
+        self.__summary_llm = self.__create_llm(temperature=self.__temperature,
+                                               openai_api_key=self._api_key,
+                                               model_name=self.__model_name)
 
-        self.__conversation_buffer = ConversationSummaryBufferMemory(
-            llm=self._llm,
-            max_token_limit=self.__conversation_buffer_token_limit
-        )
         self._conversation_chain = ConversationChain(
             llm=self._llm,
-            memory=self.__conversation_buffer
+            memory=SessionMemory(
+                llm=self.__summary_llm,
+                max_token_limit=self.__conversation_buffer_token_limit
+            )
         )
+        # pydantic copies the memory on validation, so keep the instance the chain actually uses
+        self.__conversation_buffer = self._conversation_chain.memory
+        self.__conversation_buffer.set_listener(self.__memory_listener)
+
+    def query(self, query, on_token: Callable[[str], None] = None) -> str:
+        with self._stream_handler.stream_to(on_token), tracer.span("chat.completion"):
+            return self._conversation_chain.run(query)
 
-    def query(self, query) -> str:
-        return self._conversation_chain.run(query)
+    def close(self):
+        pass
 
     @property
     def temperature(self)->float:
@@ -59,83 +144,167 @@ class OpenAIChat:
         self.__llm_factory()
 
     @property
-    def conversation_buffer(self)->ConversationSummaryBufferMemory:
+    def conversation_buffer(self)->SessionMemory:
         return self.__conversation_buffer
 
+    @property
+    def memory_listener(self) -> MemoryListener:
+        return self.__memory_listener
+
+    @memory_listener.setter
+    def memory_listener(self, value: MemoryListener):
+        self.__memory_listener = value
+        self.__conversation_buffer.set_listener(value)
+
     @property
     def conversation_chain(self)->ConversationChain:
         return self._conversation_chain
 
 
+RETRIEVAL_MODES = ("vector", "lexical", "hybrid", "auto")
+
+
 class OpenAISitemapWebSearch(OpenAIChat):
     def __init__(self, model_name: str, api_key: str, url: str, db_path: str, collection_name: str,
                  filter_urls: dict = List[str], temp: float = 0.7, load_docs_from_source: bool = False,
-                 conversation_buffer_token_limit: int = 1000, chunk_size=1000, max_pages=0):
-        super().__init__(model_name, api_key, temp, conversation_buffer_token_limit)
+                 conversation_buffer_token_limit: int = 1000, chunk_size: int = None, max_pages: int = None,
+                 crawl: CrawlSettings = None, embedding: EmbeddingSettings = None, retrieval: RetrievalSettings = None,
+                 store: StoreSettings = None, answer_cache: AnswerCacheSettings = None, registry: KnowledgeBaseRegistry = None,
+                 llm_factory: Callable[..., BaseLLM] = OpenAI):
+        super().__init__(model_name, api_key, temp, conversation_buffer_token_limit, llm_factory=llm_factory)
 
         if filter_urls is None:
             filter_urls = []
-        self.__chunk_size = chunk_size
-        self.__url = url
-        self.__collection_name = collection_name
-        self.__db_path = db_path
         self.__filter_urls = filter_urls
-        self.__max_pages = max_pages
-        self.__store = None
-
-        self.__document_loader_factory(load_docs_from_source)
+        self.__registry = registry if registry is not None else knowledge_bases
 
-    def query(self, query) -> str:
-        docs = self.__store.similarity_search(query)
-        result = self._conversation_chain({"input_documents": docs, "question": query}, return_only_outputs=True)
-        if result is not None:
-            return result["output_text"]
-        else:
-            return "No response returned"
+        # chunk_size and max_pages predate CrawlSettings and override it
+        crawl = copy.copy(crawl) if crawl is not None else CrawlSettings()
+        if chunk_size is not None:
+            crawl.chunk_size = chunk_size
+        if max_pages is not None:
+            crawl.max_pages = max_pages
+        retrieval = retrieval if retrieval is not None else RetrievalSettings()
+        if retrieval.mode not in RETRIEVAL_MODES:
+            raise ValueError("Unknown retrieval mode: {}".format(retrieval.mode))
+        self.__retrieval_mode = retrieval.mode
 
+        # sessions on the same (url, collection) share one store; only the first one ingests
+        def knowledge_base_factory(client: VectorClient) -> KnowledgeBase:
+            knowledge_base = KnowledgeBase(api_key, url, db_path, collection_name, client, crawl=crawl,
+                                           embedding=embedding, store=store, lexical_index=retrieval.lexical_index)
+            try:
+                return knowledge_base.load(load_docs_from_source)
+            except Exception:
+                knowledge_base.close()
+                raise
 
-    def __document_loader_factory(self, load_docs_from_source):
-        scraper = Scraper(self.__url, max_pages=self.__max_pages)
-        scraper.crawl()
-        docs = scraper.pages
+        # the store settings select embedded qdrant, a qdrant server or the memory-mapped numpy store
+        self.__knowledge_base = self.__registry.acquire(url, db_path, collection_name, knowledge_base_factory,
+                                                        store=store, lexical_index=retrieval.lexical_index)
+        self._conversation_chain = load_qa_with_sources_chain(self._llm, chain_type="stuff")
 
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=self.__chunk_size,
-            chunk_overlap=20,
-            length_function=len,
+        # over-fetch, then let the packer diversify, dedupe and fit the chunks into the prompt budget
+        context_token_budget = retrieval.context_token_budget
+        if context_token_budget is None:
+            context_token_budget = model_token_budget(model_name)
+        self.__retrieval_fetch_k = retrieval.fetch_k
+        self.__context_packer = ContextPacker(
+            self._llm.get_num_tokens, context_token_budget,
+            k=retrieval.k, diversity=retrieval.diversity, duplicate_threshold=retrieval.duplicate_threshold
         )
 
-        docs = text_splitter.split_documents(docs)
-        embeddings = OpenAIEmbeddings(
-            openai_api_key=self._api_key,
-            chunk_size=self.__chunk_size
-        )
+        # sessions only share cached answers when everything that shapes an answer is the same
+        self.__answer_cache = None
+        if answer_cache is not None:
+            cache_key = (model_name, temp, retrieval.mode, context_token_budget, retrieval.fetch_k, retrieval.k,
+                         retrieval.diversity, retrieval.duplicate_threshold, answer_cache.threshold)
+            self.__answer_cache = self.__knowledge_base.answer_cache(
+                cache_key, lambda: AnswerCache(answer_cache.threshold, answer_cache.ttl, answer_cache.capacity))
 
-        if load_docs_from_source or not os.path.exists(self.__db_path):
-            self.__embed_source(docs, embeddings)
-        else:
-            self.__connect_store(embeddings)
+    def query(self, query, on_token: Callable[[str], None] = None) -> str:
+        with tracer.span("query") as span:
+            return self.__query(query, on_token, span)
 
-        self._conversation_chain = load_qa_with_sources_chain(self._llm, chain_type="stuff")
+    def __query(self, query, on_token: Callable[[str], None], span) -> str:
+        knowledge_base = self.__knowledge_base
+        mode = self.__retrieval_mode
+        if mode == "auto":
+            mode = "lexical" if is_keyword_query(query) else "hybrid"
 
-    def __connect_store(self, embeddings: OpenAIEmbeddings):
-        client = qdrant_client.QdrantClient(
-            path=self.__db_path, prefer_grpc=True
-        )
-        self.__store = Qdrant(
-            client=client, collection_name=self.__collection_name,
-            embedding_function=embeddings.embed_query
-        )
+        # keyword lookups skip the embedding round-trip; they fall back to hybrid when nothing matches
+        if mode == "lexical":
+            with tracer.span("query.lexical_search"):
+                candidates = knowledge_base.lexical_search(query, self.__retrieval_fetch_k)
+            if candidates:
+                span.set("mode", mode)
+                return self.__answer(query, self.__pack(candidates), on_token)
+            mode = "hybrid"
+        span.set("mode", mode)
 
-    def __embed_source(self, docs: List[Document], embeddings: OpenAIEmbeddings):
-        self.__store = Qdrant.from_documents(
-            docs, embeddings,
-            path=self.__db_path,
-            collection_name=self.__collection_name
-        )
+        with tracer.span("query.embed"):
+            vector = knowledge_base.embeddings.embed_query(query)
+
+        # near-duplicate questions against the same collection reuse the previous answer
+        cache = self.__answer_cache
+        if cache is not None:
+            answer = cache.get(vector)
+            tracer.count("answer_cache.hits" if answer is not None else "answer_cache.misses")
+            if answer is not None:
+                if on_token is not None:
+                    on_token(answer)
+                return answer
+
+        with tracer.span("query.vector_search"):
+            candidates = knowledge_base.search_with_vectors(vector, self.__retrieval_fetch_k)
+        if mode == "hybrid":
+            with tracer.span("query.lexical_search"):
+                lexical = knowledge_base.lexical_search(query, self.__retrieval_fetch_k)
+            with tracer.span("query.fuse"):
+                candidates = knowledge_base.attach_vectors(reciprocal_rank_fusion([candidates, lexical]))
 
+        answer = self.__answer(query, self.__pack(candidates), on_token)
+        if cache is not None:
+            cache.put(query, vector, answer)
+        return answer
 
+    def __pack(self, candidates: List[Candidate]) -> List[Document]:
+        with tracer.span("query.pack", candidates=len(candidates)):
+            return self.__context_packer.pack(candidates)
 
+    def __answer(self, query: str, docs: List[Document], on_token: Callable[[str], None] = None) -> str:
+        with self._stream_handler.stream_to(on_token), tracer.span("query.completion"):
+            result = self._conversation_chain({"input_documents": docs, "question": query},
+                                              return_only_outputs=True)
+        if result is not None:
+            return result["output_text"]
+        else:
+            return "No response returned"
+
+    def close(self):
+        if self.__knowledge_base is not None:
+            self.__registry.release(self.__knowledge_base)
+            self.__knowledge_base = None
 
+    @property
+    def knowledge_base(self) -> KnowledgeBase:
+        return self.__knowledge_base
 
 
+def default_engine() -> OpenAIChat:
+    api_key = os.getenv('OPENAI_KEY')
+    # return OpenAIChat("gpt-3.5-turbo", api_key, temp=0.5)
+    return OpenAISitemapWebSearch(
+        model_name="gpt-3.5-turbo",
+        api_key=api_key,
+        # url="https://python.langchain.com/en/latest/index.html",
+        url="https://medium.com/slope-stories/slopegpt-the-first-payments-risk-model-powered-by-gpt-4-cd444ab5242d",
+        db_path="./vector_db",
+        collection_name="medium-slopegpt",
+        filter_urls=["https://python.langchain.com/en/latest/"],
+        temp=0.5,
+        load_docs_from_source=True,
+        crawl=CrawlSettings(max_pages=1),
+        embedding=EmbeddingSettings(cache_path="./embedding_cache.sqlite"),
+        retrieval=RetrievalSettings(mode="auto")
+    )
@@ -0,0 +1,89 @@
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+
+class CachedAnswer:
+    def __init__(self, question: str, answer: str, vector: np.ndarray):
+        self.question = question
+        self.answer = answer
+        self.vector = vector
+        self.created = time.monotonic()
+
+
+class AnswerCache:
+    def __init__(self, threshold: float = 0.95, ttl: float = 3600.0, capacity: int = 256):
+        self.__threshold = threshold
+        self.__ttl = ttl
+        self.__capacity = max(1, capacity)
+        self.__lock = threading.Lock()
+        self.__entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        self.__next_key = 0
+        self.__hits = 0
+        self.__misses = 0
+
+    @property
+    def hits(self) -> int:
+        return self.__hits
+
+    @property
+    def misses(self) -> int:
+        return self.__misses
+
+    def stats(self) -> Dict[str, float]:
+        with self.__lock:
+            lookups = self.__hits + self.__misses
+            return {
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "hit_rate": self.__hits / lookups if lookups else 0.0,
+                "size": len(self.__entries),
+            }
+
+    def get(self, vector: List[float]) -> Optional[str]:
+        query = self.__normalize(vector)
+        with self.__lock:
+            self.__expire()
+            if not self.__entries:
+                self.__misses += 1
+                return None
+
+            # cosine similarity against every cached question in one product
+            keys = list(self.__entries.keys())
+            matrix = np.stack([self.__entries[key].vector for key in keys])
+            scores = matrix @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.__threshold:
+                self.__misses += 1
+                return None
+
+            self.__entries.move_to_end(keys[best])
+            self.__hits += 1
+            return self.__entries[keys[best]].answer
+
+    def put(self, question: str, vector: List[float], answer: str):
+        with self.__lock:
+            self.__entries[self.__next_key] = CachedAnswer(question, answer, self.__normalize(vector))
+            self.__next_key += 1
+            while len(self.__entries) > self.__capacity:
+                self.__entries.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def __expire(self):
+        if self.__ttl <= 0:
+            return
+
+        cutoff = time.monotonic() - self.__ttl
+        for key in [key for key, entry in self.__entries.items() if entry.created < cutoff]:
+            del self.__entries[key]
+
+    @staticmethod
+    def __normalize(vector: List[float]) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm > 0 else array
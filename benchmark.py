@@ -0,0 +1,374 @@
+import os
+import sys
+import json
+import time
+import zlib
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+import qdrant_client
+from bs4 import BeautifulSoup
+from langchain.embeddings import FakeEmbeddings
+from langchain.llms.base import LLM
+from langchain.schema import Document
+from ai import OpenAIChat, OpenAISitemapWebSearch
+from embedding_providers import HashingEmbeddingProvider
+from indexer import IncrementalIndexer
+from ingest import split_pages
+from knowledge_base import KnowledgeBaseRegistry
+from settings import CrawlSettings, EmbeddingSettings, RetrievalSettings, StoreSettings
+from scraper import Scraper, extract_page
+from session_store import SessionStore
+from tracing import MetricsCollector, tracer
+
+FAKE_WORDS = ("the", "client", "retries", "requests", "tokens", "are", "counted", "per", "call", "and", "each",
+              "parameter", "is", "documented", "in", "the", "reference", "section", "below")
+
+
+# the two-pass html.parser extraction Scraper used before extract_page, kept for comparison
+def legacy_extract(content: bytes) -> Tuple[List[str], str]:
+    link_soup = BeautifulSoup(content, 'html.parser')
+    links = [item["href"] for item in link_soup.find_all("a", href=True)]
+    links = list(filter(lambda lnk: '#' not in lnk, links))
+
+    content_soup = BeautifulSoup(content, 'html.parser')
+    content_list = [item.text for item in content_soup.select("div")]
+    return links, ''.join(content_list)
+
+
+def generate_page(index: int, sections: int = 20, depth: int = 4, site_pages: int = 0) -> bytes:
+    paragraph = ("Section {} of page {} explains how the client retries requests, "
+                 "how tokens are counted and which parameters the API accepts. ")
+
+    body = []
+    for section in range(sections):
+        inner = "<p>{}</p><pre><code>client.query({})</code></pre>".format(paragraph.format(section, index) * 4, section)
+        # docs themes wrap content in several layers of divs
+        for _ in range(depth):
+            inner = '<div class="wrapper">{}</div>'.format(inner)
+        body.append(inner)
+
+    # in a generated site the links wrap around, so every page is reachable and none is missing
+    targets = range(index, index + 30) if not site_pages else [(index + i) % site_pages for i in range(1, 31)]
+    links = "".join('<li><a href="/page/{0}">Page {0}</a></li>'.format(i) for i in targets)
+    return """<!DOCTYPE html>
+<html><head><title>Page {index}</title><style>body {{ color: #333; }}</style>
+<script>window.analytics = {{}};</script></head>
+<body>
+<header><div class="logo">Docs</div></header>
+<nav><ul>{links}</ul></nav>
+<main><div class="content"><h1>Page {index}</h1>{body}</div></main>
+<footer><div>Copyright</div></footer>
+</body></html>""".format(index=index, links=links, body="\n".join(body)).encode("utf-8")
+
+
+def bench_extractor(name: str, extractor: Callable[[bytes], Tuple[List[str], str]], pages: List[bytes]):
+    input_bytes = sum(len(page) for page in pages)
+
+    start = time.perf_counter()
+    output_bytes = 0
+    for page in pages:
+        _, text = extractor(page)
+        output_bytes += len(text.encode("utf-8"))
+    elapsed = time.perf_counter() - start
+
+    print("{:<8} {:>10.2f} MB/s {:>12} bytes out {:>8.2f}x input".format(
+        name, input_bytes / elapsed / 1e6, output_bytes, output_bytes / input_bytes))
+
+
+def extract_benchmark(args):
+    if args.files:
+        pages = []
+        for file in args.files:
+            with open(file, "rb") as f:
+                pages.append(f.read())
+    else:
+        pages = [generate_page(i) for i in range(args.pages)]
+
+    print("{} pages, {} bytes in".format(len(pages), sum(len(page) for page in pages)))
+    bench_extractor("before", legacy_extract, pages)
+    bench_extractor("after", extract_page, pages)
+
+
+def build_collection(db_path: str, collection_name: str, chunks: int):
+    docs = [Document(page_content="chunk {} of the benchmark collection".format(i),
+                     metadata={"source": "http://benchmark.local/page/{}".format(i // 10)})
+            for i in range(chunks)]
+    client = qdrant_client.QdrantClient(path=db_path)
+    IncrementalIndexer(client, collection_name, FakeEmbeddings(size=1536),
+                       manifest_path=os.path.join(db_path, collection_name + ".manifest.json")).index(docs)
+
+
+def startup_benchmark(args):
+    with tempfile.TemporaryDirectory() as db_path:
+        # the embedded Qdrant lock is per process, so the fixture is written from a child process
+        builder = multiprocessing.Process(target=build_collection, args=(db_path, "benchmark", args.chunks))
+        builder.start()
+        builder.join()
+
+        # an unreachable url makes any attempt to crawl fail loudly
+        start = time.perf_counter()
+        OpenAISitemapWebSearch(model_name="gpt-3.5-turbo", api_key="sk-benchmark", url="http://invalid",
+                               db_path=db_path, collection_name="benchmark")
+        elapsed = time.perf_counter() - start
+
+    print("opened {} chunk collection in {:.3f}s (limit {:.3f}s)".format(args.chunks, elapsed, args.limit))
+    if elapsed > args.limit:
+        sys.exit(1)
+
+
+class FakeLLM(LLM):
+    # takes the same arguments as OpenAI and answers deterministically from the prompt, without the network
+    temperature: float = 0.7
+    openai_api_key: Optional[str] = None
+    model_name: str = "fake"
+    streaming: bool = False
+    reply_words: int = 32
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        seed = zlib.crc32(prompt.encode("utf-8"))
+        words = [FAKE_WORDS[(seed + i * 7919) % len(FAKE_WORDS)] for i in range(self.reply_words)]
+        if self.streaming:
+            for word in words:
+                self.callback_manager.on_llm_new_token(word + " ", verbose=self.verbose)
+        return " ".join(words)
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(text.split())
+
+
+class SiteServer:
+    # serves generate_page() output on localhost so crawls need no network
+    def __init__(self, pages: List[bytes]):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parts = self.path.strip("/").split("/")
+                index = int(parts[1]) if len(parts) == 2 and parts[0] == "page" and parts[1].isdigit() else -1
+                if not 0 <= index < len(pages):
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(pages[index])))
+                self.end_headers()
+                self.wfile.write(pages[index])
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{}/page/0".format(self.__server.server_address[1])
+
+    def __enter__(self):
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+
+def timed(func: Callable, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def percentiles(seconds: List[float]) -> Dict[str, float]:
+    millis = np.asarray(seconds) * 1000
+    return {"p50_ms": round(float(np.percentile(millis, 50)), 3), "p99_ms": round(float(np.percentile(millis, 99)), 3)}
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_session_switch(sessions: int, messages: int) -> Dict[str, float]:
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtWidgets import QApplication
+    import pychat
+
+    class BenchmarkWindow(pychat.ChatWindow):
+        def engine_factory(self, session_key: str):
+            return OpenAIChat("fake", "sk-benchmark", llm_factory=FakeLLM)
+
+    with tempfile.TemporaryDirectory() as directory:
+        store_path = os.path.join(directory, "sessions.sqlite")
+        store = SessionStore(store_path)
+        for session in range(sessions):
+            key = "session-{}".format(session)
+            store.add_session(key)
+            for message in range(messages):
+                store.append_message(key, "User" if message % 2 == 0 else "AI",
+                                     "message {} of {}: ".format(message, key) + " ".join(FAKE_WORDS))
+        store.close()
+
+        app = QApplication.instance() or QApplication([])
+        window = BenchmarkWindow(session_store_path=store_path)
+        window.show()
+        app.processEvents()
+
+        # the first visit loads the transcript and engine, later visits only swap the model
+        results = {}
+        for visit in ("cold", "warm"):
+            switches = []
+            for index in range(sessions):
+                start = time.perf_counter()
+                window.checklist.select_session(index)
+                app.processEvents()
+                switches.append(time.perf_counter() - start)
+            results.update({"{}_{}".format(visit, name): value for name, value in percentiles(switches).items()})
+        window.close()
+    return results
+
+
+def suite_benchmark(args):
+    pages = [generate_page(i, site_pages=args.pages) for i in range(args.pages)]
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "parameters": {name: value for name, value in vars(args).items() if name not in ("func", "command")},
+    }
+
+    # extraction on its own, from memory
+    input_bytes = sum(len(page) for page in pages)
+    _, elapsed = timed(lambda: [extract_page(page) for page in pages])
+    results["extract_mb_per_sec"] = round(input_bytes / elapsed / 1e6, 3)
+
+    with SiteServer(pages) as site:
+        scraper = Scraper(site.url, workers=args.crawl_workers)
+        docs, elapsed = timed(lambda: list(scraper.crawl_iter()))
+        results["crawl_pages"] = len(docs)
+        results["crawl_pages_per_sec"] = round(len(docs) / elapsed, 3)
+
+        chunks, elapsed = timed(split_pages, [(doc.page_content, doc.metadata) for doc in docs], args.chunk_size, 20)
+        results["split_chunks"] = len(chunks)
+        results["split_chunks_per_sec"] = round(len(chunks) / elapsed, 3)
+
+        provider = HashingEmbeddingProvider()
+        texts = [text for text, _ in chunks]
+        _, elapsed = timed(lambda: [provider.embed_documents(texts[i:i + 64]) for i in range(0, len(texts), 64)])
+        results["embed_chunks_per_sec"] = round(len(texts) / elapsed, 3)
+
+        with tempfile.TemporaryDirectory() as db_path:
+            # per-stage timings and counters of the ingest and the queries go into the results as well
+            collector = MetricsCollector()
+            if args.trace:
+                tracer.add_listener(collector)
+
+            # a private registry so nothing is shared with other engines in this process
+            registry = KnowledgeBaseRegistry()
+            engine, elapsed = timed(
+                OpenAISitemapWebSearch, model_name="gpt-3.5-turbo", api_key="sk-benchmark", url=site.url,
+                db_path=db_path, collection_name="benchmark", load_docs_from_source=True,
+                crawl=CrawlSettings(workers=args.crawl_workers, chunk_size=args.chunk_size),
+                embedding=EmbeddingSettings(provider="hashing"), retrieval=RetrievalSettings(mode="auto"),
+                store=StoreSettings(vector_store=args.vector_store), registry=registry, llm_factory=FakeLLM
+            )
+            results["ingest_seconds"] = round(elapsed, 3)
+            if args.trace:
+                results["ingest_trace"] = collector.snapshot()
+                collector.reset()
+
+            # alternate natural-language questions (vector and hybrid) with keyword lookups (lexical)
+            latencies = []
+            for i in range(args.queries):
+                query = ("How does the client retry requests on page {}?".format(i % args.pages) if i % 2 == 0
+                         else "client.query({})".format(i % 20))
+                _, elapsed = timed(engine.query, query)
+                latencies.append(elapsed)
+            results["query"] = percentiles(latencies)
+            if args.trace:
+                results["query_trace"] = collector.snapshot()
+            tracer.remove_listener(collector)
+            engine.close()
+
+    if not args.skip_ui:
+        try:
+            results["session_switch"] = bench_session_switch(args.sessions, args.messages)
+        except ImportError as error:
+            print("Skipping the session switch benchmark: {}".format(error))
+
+    print(json.dumps(results, indent=2))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+
+def flatten(results: dict, prefix: str = "") -> Dict[str, float]:
+    metrics = {}
+    for name, value in results.items():
+        if isinstance(value, dict) and name != "parameters":
+            metrics.update(flatten(value, prefix + name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and name != "timestamp":
+            metrics[prefix + name] = value
+    return metrics
+
+
+def compare_benchmark(args):
+    with open(args.before, "r", encoding="utf-8") as f:
+        before = flatten(json.load(f))
+    with open(args.after, "r", encoding="utf-8") as f:
+        after = flatten(json.load(f))
+
+    for name in sorted(before.keys() & after.keys()):
+        change = (after[name] - before[name]) / before[name] * 100 if before[name] else 0.0
+        print("{:<32} {:>12} {:>12} {:>+9.1f}%".format(name, before[name], after[name], change))
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(description="pychat performance benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    extract = commands.add_parser("extract", help="HTML extraction throughput and output size")
+    extract.add_argument("--pages", type=int, default=200, help="number of generated pages")
+    extract.add_argument("files", nargs="*", help="saved HTML pages to use instead of generated ones")
+    extract.set_defaults(func=extract_benchmark)
+
+    startup = commands.add_parser("startup", help="time to open an already indexed collection")
+    startup.add_argument("--chunks", type=int, default=2000, help="number of chunks in the collection")
+    startup.add_argument("--limit", type=float, default=1.0, help="fail if opening takes longer (seconds)")
+    startup.set_defaults(func=startup_benchmark)
+
+    suite = commands.add_parser("suite", help="offline crawl, ingest, query and UI benchmarks written to JSON")
+    suite.add_argument("--pages", type=int, default=100, help="number of pages in the generated site")
+    suite.add_argument("--crawl-workers", type=int, default=4)
+    suite.add_argument("--chunk-size", type=int, default=1000)
+    suite.add_argument("--vector-store", default="numpy", help="qdrant, qdrant-server or numpy")
+    suite.add_argument("--queries", type=int, default=200, help="number of timed queries")
+    suite.add_argument("--sessions", type=int, default=20, help="sessions in the UI switch benchmark")
+    suite.add_argument("--messages", type=int, default=200, help="messages per session in the UI switch benchmark")
+    suite.add_argument("--skip-ui", action="store_true", help="skip the Qt session switch benchmark")
+    suite.add_argument("--trace", action="store_true", help="add per-stage span timings and counters to the results")
+    suite.add_argument("--output", default="benchmark-results.json")
+    suite.set_defaults(func=suite_benchmark)
+
+    compare = commands.add_parser("compare", help="compare two suite result files")
+    compare.add_argument("before")
+    compare.add_argument("after")
+    compare.set_defaults(func=compare_benchmark)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,79 @@
+import json
+import requests
+from typing import Callable, List, Tuple
+
+USER_HEADER = "X-Pychat-User"
+
+
+def session_url(server_url: str, session_name: str) -> str:
+    return "{}/sessions/{}".format(server_url.rstrip("/"), requests.utils.quote(session_name, safe=""))
+
+
+class RemoteChatEngine:
+    # the query interface of OpenAIChat, answered by a pychat server instead of a local engine
+    def __init__(self, server_url: str, user: str, session_name: str, timeout: float = 120.0):
+        self.__base_url = session_url(server_url, session_name)
+        self.__timeout = timeout
+        self.__http = requests.Session()
+        self.__http.headers[USER_HEADER] = user
+
+    def query(self, query, on_token: Callable[[str], None] = None) -> str:
+        with self.__http.post(self.__base_url + "/messages", json={"message": query}, stream=True,
+                              timeout=self.__timeout) as response:
+            if response.status_code == 503:
+                raise RuntimeError("Server busy: {}".format(response.json().get("error")))
+            response.raise_for_status()
+
+            # closing the response early (a raising on_token) tells the server to cancel the reply
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event["type"] == "token":
+                    if on_token is not None:
+                        on_token(event["token"])
+                elif event["type"] == "done":
+                    return event["response"]
+                elif event["type"] == "error":
+                    raise RuntimeError(event["error"])
+
+        raise RuntimeError("The server closed the reply early")
+
+    def close(self):
+        self.__http.close()
+
+
+class RemoteSessionStore:
+    # the parts of SessionStore the window uses, kept by a pychat server. The server records both sides of
+    # every reply itself, so appended messages are not sent again
+    def __init__(self, server_url: str, user: str, timeout: float = 30.0):
+        self.__server_url = server_url
+        self.__timeout = timeout
+        self.__http = requests.Session()
+        self.__http.headers[USER_HEADER] = user
+
+    def list_sessions(self) -> List[str]:
+        response = self.__http.get(self.__server_url.rstrip("/") + "/sessions", timeout=self.__timeout)
+        response.raise_for_status()
+        return response.json()["sessions"]
+
+    def add_session(self, session_key: str):
+        self.__http.put(session_url(self.__server_url, session_key), timeout=self.__timeout).raise_for_status()
+
+    def remove_session(self, session_key: str):
+        self.__http.delete(session_url(self.__server_url, session_key), timeout=self.__timeout).raise_for_status()
+
+    def append_message(self, session_key: str, role: str, text: str):
+        pass
+
+    def load_messages(self, session_key: str) -> List[Tuple[str, str]]:
+        response = self.__http.get(session_url(self.__server_url, session_key) + "/messages", timeout=self.__timeout)
+        response.raise_for_status()
+        return [(message["role"], message["text"]) for message in response.json()["messages"]]
+
+    def clear_messages(self, session_key: str):
+        self.__http.delete(session_url(self.__server_url, session_key) + "/messages",
+                           timeout=self.__timeout).raise_for_status()
+
+    def close(self):
+        self.__http.close()
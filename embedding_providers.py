@@ -0,0 +1,158 @@
+import os
+import re
+import zlib
+from abc import abstractmethod
+import numpy as np
+from typing import Dict, List, Optional
+from langchain.embeddings.base import Embeddings
+from langchain.embeddings.openai import OpenAIEmbeddings
+
+OPENAI_DIMENSIONS = {"text-embedding-ada-002": 1536}
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+class EmbeddingProvider(Embeddings):
+    # name, model and dimension are recorded with the collection so a different provider is caught on reopen
+    name = ""
+
+    @property
+    @abstractmethod
+    def model(self) -> str:
+        pass
+
+    @property
+    @abstractmethod
+    def dimension(self) -> int:
+        pass
+
+    @abstractmethod
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        pass
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def close(self):
+        pass
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    name = "openai"
+
+    def __init__(self, api_key: str, model: str = "text-embedding-ada-002", batch_size: int = 256):
+        # one API request per batch, retries are handled by CachedEmbeddings
+        self.__embeddings = OpenAIEmbeddings(openai_api_key=api_key, model=model, chunk_size=batch_size,
+                                             max_retries=1)
+
+    @property
+    def model(self) -> str:
+        return self.__embeddings.model
+
+    @property
+    def dimension(self) -> int:
+        return OPENAI_DIMENSIONS.get(self.model, 0)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.__embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.__embeddings.embed_query(text)
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    name = "local"
+
+    def __init__(self, model: str = "sentence-transformers/all-MiniLM-L6-v2", batch_size: int = 64,
+                 processes: int = None, device: str = "cpu"):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError("The local embedding provider needs sentence-transformers: "
+                              "pip install sentence-transformers")
+
+        self.__model_name = model
+        self.__batch_size = max(1, batch_size)
+        self.__processes = processes if processes is not None else (os.cpu_count() or 1)
+        self.__model = SentenceTransformer(model, device=device)
+        self.__pool = None
+
+    @property
+    def model(self) -> str:
+        return self.__model_name
+
+    @property
+    def dimension(self) -> int:
+        return self.__model.get_sentence_embedding_dimension()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # large ingest batches are spread over one worker process per core, small ones stay in process
+        if self.__processes > 1 and len(texts) >= self.__batch_size * self.__processes:
+            if self.__pool is None:
+                self.__pool = self.__model.start_multi_process_pool(["cpu"] * self.__processes)
+            vectors = self.__model.encode_multi_process(texts, self.__pool, batch_size=self.__batch_size)
+            vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True).clip(min=1e-12)
+        else:
+            vectors = self.__model.encode(texts, batch_size=self.__batch_size, normalize_embeddings=True,
+                                          convert_to_numpy=True, show_progress_bar=False)
+        return vectors.astype(np.float32).tolist()
+
+    def close(self):
+        if self.__pool is not None:
+            self.__model.stop_multi_process_pool(self.__pool)
+            self.__pool = None
+
+
+class HashingEmbeddingProvider(EmbeddingProvider):
+    name = "hashing"
+
+    def __init__(self, dimension: int = 256, ngram_range: tuple = (1, 2)):
+        self.__dimension = dimension
+        self.__ngram_range = ngram_range
+
+    @property
+    def model(self) -> str:
+        return "hashing-{}-{}-{}".format(self.__dimension, *self.__ngram_range)
+
+    @property
+    def dimension(self) -> int:
+        return self.__dimension
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # signed feature hashing of word n-grams; crc32 keeps vectors identical across processes and runs
+        rows, columns, signs = [], [], []
+        for row, text in enumerate(texts):
+            for feature in self.__features(text):
+                digest = zlib.crc32(feature.encode("utf-8"))
+                rows.append(row)
+                columns.append(digest % self.__dimension)
+                signs.append(1.0 if digest & 0x80000000 else -1.0)
+
+        flat = np.asarray(rows, dtype=np.int64) * self.__dimension + np.asarray(columns, dtype=np.int64)
+        vectors = np.bincount(flat, weights=signs, minlength=len(texts) * self.__dimension)
+        vectors = vectors.reshape(len(texts), self.__dimension).astype(np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / np.where(norms > 0, norms, 1.0)).tolist()
+
+    def __features(self, text: str) -> List[str]:
+        words = TOKEN_PATTERN.findall(text.lower())
+        low, high = self.__ngram_range
+        return [" ".join(words[i:i + n]) for n in range(low, high + 1) for i in range(len(words) - n + 1)]
+
+
+EMBEDDING_PROVIDERS = {
+    OpenAIEmbeddingProvider.name: OpenAIEmbeddingProvider,
+    LocalEmbeddingProvider.name: LocalEmbeddingProvider,
+    HashingEmbeddingProvider.name: HashingEmbeddingProvider,
+}
+
+
+def embedding_provider_factory(name: str, api_key: str = None, batch_size: int = 256,
+                               options: Optional[Dict] = None) -> EmbeddingProvider:
+    if name not in EMBEDDING_PROVIDERS:
+        raise ValueError("Unknown embedding provider: {}".format(name))
+
+    options = dict(options or {})
+    if name == OpenAIEmbeddingProvider.name:
+        options.setdefault("api_key", api_key)
+        options.setdefault("batch_size", batch_size)
+    return EMBEDDING_PROVIDERS[name](**options)
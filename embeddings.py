@@ -0,0 +1,213 @@
+import time
+import random
+import sqlite3
+import hashlib
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from langchain.embeddings.base import Embeddings
+from tracing import tracer
+
+# provider errors worth retrying, matched by name so no provider SDK has to be importable here
+RETRYABLE_ERRORS = {"RateLimitError", "ServiceUnavailableError", "APIError", "APIConnectionError", "Timeout",
+                    "TryAgain", "ConnectionError"}
+RATE_LIMIT_ERRORS = {"RateLimitError"}
+
+
+class EmbeddingCache:
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        self.__max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.__connection.commit()
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha256((model + "\0" + text).encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found: Dict[str, List[float]] = {}
+        with self.__lock:
+            # stay well below sqlite's bound parameter limit
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self.__connection.execute(
+                    "SELECT key, vector FROM embeddings WHERE key IN ({})".format(",".join("?" * len(batch))), batch
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+
+            if found:
+                now = time.time()
+                self.__connection.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                              [(now, key) for key in found])
+                self.__connection.commit()
+
+        return found
+
+    def put_many(self, entries: Dict[str, List[float]]):
+        now = time.time()
+        rows = []
+        for key, vector in entries.items():
+            blob = array("f", vector).tobytes()
+            rows.append((key, blob, len(blob), now))
+
+        with self.__lock:
+            self.__connection.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self.__evict()
+            self.__connection.commit()
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+    def __evict(self):
+        total = self.__connection.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+        if total <= self.__max_bytes:
+            return
+
+        # drop least recently used entries until the cache is back under 90% of its budget
+        excess = total - int(self.__max_bytes * 0.9)
+        keys = []
+        for key, size in self.__connection.execute("SELECT key, size FROM embeddings ORDER BY last_used"):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.__connection.executemany("DELETE FROM embeddings WHERE key = ?", keys)
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, provider: Embeddings, model: str, cache: Optional[EmbeddingCache] = None,
+                 batch_size: int = 256, max_batch_chars: int = 200000, max_concurrency: int = 4,
+                 max_retries: int = 6):
+        self.__provider = provider
+        self.__model = model
+        self.__cache = cache
+        self.__batch_size = max(1, batch_size)
+        self.__max_batch_chars = max_batch_chars
+        self.__max_concurrency = max(1, max_concurrency)
+        self.__max_retries = max_retries
+
+        # a rate limit seen by one worker pauses all of them
+        self.__pause_lock = threading.Lock()
+        self.__paused_until = 0.0
+
+    @property
+    def provider(self) -> Embeddings:
+        return self.__provider
+
+    @property
+    def model(self) -> str:
+        return self.__model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [EmbeddingCache.key(self.__model, text) for text in texts]
+        vectors = self.__cache.get_many(list(set(keys))) if self.__cache is not None else {}
+
+        misses: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                misses[key] = text
+        if self.__cache is not None:
+            tracer.count("embedding_cache.hits", len(keys) - len(misses))
+            tracer.count("embedding_cache.misses", len(misses))
+
+        if misses:
+            embedded = self.__embed_misses(misses)
+            if self.__cache is not None:
+                self.__cache.put_many(embedded)
+            vectors.update(embedded)
+
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = EmbeddingCache.key(self.__model, text)
+        if self.__cache is not None:
+            cached = self.__cache.get_many([key])
+            if key in cached:
+                tracer.count("embedding_cache.hits")
+                return cached[key]
+            tracer.count("embedding_cache.misses")
+
+        vector = self.__with_retries(self.__provider.embed_query, text)
+        if self.__cache is not None:
+            self.__cache.put_many({key: vector})
+        return vector
+
+    def __embed_misses(self, misses: Dict[str, str]) -> Dict[str, List[float]]:
+        batches = self.__batches(list(misses.items()))
+        if len(batches) == 1 or self.__max_concurrency == 1:
+            results = [self.__embed_batch(batch) for batch in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.__max_concurrency, len(batches))) as pool:
+                results = list(pool.map(self.__embed_batch, batches))
+
+        embedded: Dict[str, List[float]] = {}
+        for result in results:
+            embedded.update(result)
+        return embedded
+
+    def __batches(self, items: List[tuple]) -> List[List[tuple]]:
+        batches = []
+        batch = []
+        chars = 0
+        for key, text in items:
+            if batch and (len(batch) >= self.__batch_size or chars + len(text) > self.__max_batch_chars):
+                batches.append(batch)
+                batch = []
+                chars = 0
+            batch.append((key, text))
+            chars += len(text)
+
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __embed_batch(self, batch: List[tuple]) -> Dict[str, List[float]]:
+        tracer.count("embedding.texts", len(batch))
+        if tracer.enabled:
+            tracer.count("embedding.bytes", sum(len(text.encode("utf-8")) for _, text in batch))
+        vectors = self.__with_retries(self.__provider.embed_documents, [text for _, text in batch])
+        return {key: vector for (key, _), vector in zip(batch, vectors)}
+
+    def __with_retries(self, func, arg):
+        attempt = 0
+        while True:
+            self.__wait_if_paused()
+            try:
+                # one span per provider request, retries included
+                with tracer.span("embedding.request", texts=len(arg) if isinstance(arg, list) else 1):
+                    return func(arg)
+            except Exception as error:
+                name = type(error).__name__
+                attempt += 1
+                if name not in RETRYABLE_ERRORS or attempt > self.__max_retries:
+                    raise
+
+                # exponential backoff with jitter, capped at a minute
+                delay = min(60.0, 2 ** attempt) * (0.5 + random.random() / 2)
+                print("Embedding request failed ({}), retrying in {:.1f}s".format(name, delay))
+                if name in RATE_LIMIT_ERRORS:
+                    self.__pause(delay)
+                else:
+                    time.sleep(delay)
+
+    def __pause(self, delay: float):
+        with self.__pause_lock:
+            self.__paused_until = max(self.__paused_until, time.monotonic() + delay)
+
+    def __wait_if_paused(self):
+        with self.__pause_lock:
+            remaining = self.__paused_until - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
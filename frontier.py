@@ -0,0 +1,139 @@
+import os
+import json
+from collections import deque
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+from langchain.schema import Document
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url: str) -> str:
+    parts = urlparse(url)
+    scheme = parts.scheme.lower()
+
+    netloc = (parts.hostname or "").lower()
+    if parts.port is not None and DEFAULT_PORTS.get(scheme) != parts.port:
+        netloc = "{}:{}".format(netloc, parts.port)
+    if parts.username:
+        userinfo = parts.username if parts.password is None else parts.username + ":" + parts.password
+        netloc = userinfo + "@" + netloc
+
+    path = parts.path or "/"
+    if len(path) > 1 and path.endswith("/"):
+        path = path.rstrip("/") or "/"
+
+    # sort query parameters so ?a=1&b=2 and ?b=2&a=1 are the same page
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+
+    return urlunparse((scheme, netloc, path, parts.params, query, ""))
+
+
+class CrawlFrontier:
+    # urls are queued as they were linked, only the dedup key is normalized: a page at /guide/ must be
+    # fetched from there, or its relative links would resolve against the parent directory
+    def __init__(self, queue: Iterable[str] = (), seen: Iterable[str] = ()):
+        self.__queue = deque(queue)
+        self.__seen: Set[str] = set(seen)
+        self.__seen.update(normalize_url(url) for url in self.__queue)
+
+    def push(self, url: str) -> bool:
+        key = normalize_url(url)
+        if key in self.__seen:
+            return False
+
+        self.__seen.add(key)
+        self.__queue.append(url)
+        return True
+
+    def pop(self) -> str:
+        return self.__queue.popleft()
+
+    def __len__(self) -> int:
+        return len(self.__queue)
+
+    def __contains__(self, url: str) -> bool:
+        return normalize_url(url) in self.__seen
+
+    @property
+    def queue(self) -> List[str]:
+        return list(self.__queue)
+
+    @property
+    def seen(self) -> Set[str]:
+        return self.__seen
+
+
+class CrawlCheckpoint:
+    def __init__(self, path: str):
+        self.__path = path
+        self.__state_file = os.path.join(path, "frontier.json")
+        self.__pages_file = os.path.join(path, "pages.jsonl")
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    def exists(self) -> bool:
+        return os.path.exists(self.__state_file)
+
+    def load(self) -> Tuple[CrawlFrontier, int]:
+        with open(self.__state_file, "r", encoding="utf-8") as f:
+            state = json.load(f)
+
+        # pages written after the last frontier save are still queued in that frontier, so drop them
+        page_count = state["page_count"]
+        offset = 0
+        if page_count > 0:
+            with open(self.__pages_file, "rb") as f:
+                for _ in range(page_count):
+                    offset += len(f.readline())
+
+        with open(self.__pages_file, "ab") as f:
+            f.truncate(offset)
+
+        return CrawlFrontier(state["queue"], state["seen"]), page_count
+
+    def pages(self) -> Iterator[Document]:
+        # read lazily so resuming a large crawl does not hold every page in memory
+        if not os.path.exists(self.__pages_file):
+            return
+
+        with open(self.__pages_file, "r", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                yield Document(page_content=record["page_content"], metadata=record["metadata"])
+
+    def save(self, frontier: CrawlFrontier, in_flight: Iterable[str], pages: List[Document], page_count: int) -> int:
+        os.makedirs(self.__path, exist_ok=True)
+
+        # only the pages fetched since the previous save are appended
+        with open(self.__pages_file, "a", encoding="utf-8") as f:
+            self.__write_pages(f, pages)
+
+        # in-flight urls go back to the front of the queue so they are fetched again on resume
+        state = {
+            "page_count": page_count,
+            "queue": list(in_flight) + frontier.queue,
+            "seen": sorted(frontier.seen),
+        }
+        tmp_file = self.__state_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.__state_file)
+
+        return page_count
+
+    def clear(self):
+        for file in (self.__state_file, self.__pages_file):
+            if os.path.exists(file):
+                os.remove(file)
+
+    @staticmethod
+    def __write_pages(f, pages: List[Document]):
+        for doc in pages:
+            f.write(json.dumps({"page_content": doc.page_content, "metadata": doc.metadata}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
@@ -0,0 +1,75 @@
+import os
+import json
+import hashlib
+from typing import Dict, List, Optional
+from langchain.schema import Document
+
+
+class CachedResponse:
+    def __init__(self, url: str, etag: Optional[str], last_modified: Optional[str], links: List[str],
+                 page_content: str, metadata: dict):
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.links = links
+        self.page_content = page_content
+        self.metadata = metadata
+
+    @property
+    def document(self) -> Document:
+        return Document(page_content=self.page_content, metadata=dict(self.metadata))
+
+    @property
+    def conditional_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    def __init__(self, path: str):
+        self.__path = path
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, url: str) -> Optional[CachedResponse]:
+        file = self.__file(url)
+        if not os.path.exists(file):
+            return None
+
+        try:
+            with open(file, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError) as error:
+            print(error)
+            return None
+
+        if entry.get("url") != url:
+            return None
+
+        return CachedResponse(entry["url"], entry.get("etag"), entry.get("last_modified"), entry["links"],
+                              entry["page_content"], entry["metadata"])
+
+    def put(self, url: str, etag: Optional[str], last_modified: Optional[str], links: List[str], doc: Document):
+        # without a validator there is nothing to revalidate against
+        if not etag and not last_modified:
+            return
+
+        entry = {
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "links": links,
+            "page_content": doc.page_content,
+            "metadata": doc.metadata,
+        }
+        file = self.__file(url)
+        tmp_file = file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_file, file)
+
+    def __file(self, url: str) -> str:
+        return os.path.join(self.__path, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
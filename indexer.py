@@ -0,0 +1,284 @@
+import os
+import json
+import uuid
+import hashlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from qdrant_client import QdrantClient
+from qdrant_client.http import models
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+from lexical_index import LexicalIndex
+from tracing import tracer
+
+
+def chunk_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def point_id(source: str, text_hash: str) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, source + "#" + text_hash))
+
+
+def collection_exists(client: QdrantClient, collection_name: str) -> bool:
+    return any(collection.name == collection_name for collection in client.get_collections().collections)
+
+
+class CollectionSettings:
+    def __init__(self, hnsw_m: int = 16, hnsw_ef_construct: int = 100, hnsw_ef: Optional[int] = 128,
+                 quantization: bool = False, quantization_quantile: float = 0.99, quantization_rescore: bool = True,
+                 on_disk_payload: bool = False, payload_indexes: Tuple[str, ...] = ("metadata.source",)):
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construct = hnsw_ef_construct
+        self.hnsw_ef = hnsw_ef
+        self.quantization = quantization
+        self.quantization_quantile = quantization_quantile
+        self.quantization_rescore = quantization_rescore
+        self.on_disk_payload = on_disk_payload
+        self.payload_indexes = payload_indexes
+
+    def create_options(self) -> dict:
+        options = {
+            "hnsw_config": models.HnswConfigDiff(m=self.hnsw_m, ef_construct=self.hnsw_ef_construct),
+            "on_disk_payload": self.on_disk_payload,
+        }
+        # int8 scalar quantization keeps a 4x smaller copy of the vectors in RAM; originals rescore the top hits
+        if self.quantization:
+            options["quantization_config"] = models.ScalarQuantization(
+                scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8,
+                                                       quantile=self.quantization_quantile, always_ram=True)
+            )
+        return options
+
+    def search_params(self) -> Optional[models.SearchParams]:
+        if self.hnsw_ef is None and not self.quantization:
+            return None
+
+        quantization = models.QuantizationSearchParams(rescore=self.quantization_rescore) if self.quantization else None
+        return models.SearchParams(hnsw_ef=self.hnsw_ef, quantization=quantization)
+
+
+class IndexStats:
+    def __init__(self, added: int = 0, removed: int = 0, unchanged: int = 0):
+        self.added = added
+        self.removed = removed
+        self.unchanged = unchanged
+
+    def __repr__(self):
+        return "IndexStats(added={}, removed={}, unchanged={})".format(self.added, self.removed, self.unchanged)
+
+
+class IncrementalIndexer:
+    def __init__(self, client: QdrantClient, collection_name: str, embeddings: Embeddings, manifest_path: str,
+                 batch_size: int = 64, content_payload_key: str = "page_content",
+                 metadata_payload_key: str = "metadata", lexical_index: LexicalIndex = None,
+                 settings: CollectionSettings = None, upsert_workers: int = 1):
+        self.__client = client
+        self.__collection_name = collection_name
+        self.__embeddings = embeddings
+        self.__manifest_path = manifest_path
+        self.__batch_size = max(1, batch_size)
+        self.__content_payload_key = content_payload_key
+        self.__metadata_payload_key = metadata_payload_key
+        self.__lexical_index = lexical_index
+        self.__settings = settings
+        self.__upsert_workers = max(1, upsert_workers)
+
+    def index(self, docs: List[Document]) -> IndexStats:
+        self.begin()
+        self.add(docs)
+        return self.finish()
+
+    def rebuild(self, docs: List[Document]) -> IndexStats:
+        self.begin(rebuild=True)
+        self.add(docs)
+        return self.finish()
+
+    def begin(self, rebuild: bool = False):
+        # chunks can then be streamed in with add(); finish() removes whatever was not seen again
+        manifest = self.__load_manifest()
+
+        # a rebuild, or points written by something other than this indexer, start over; the old collection
+        # is only dropped once the first new batch is ready, so a crawl that fails early leaves it in place
+        self.__drop_pending = rebuild or not self.__manifest_matches_collection(manifest)
+        if self.__drop_pending:
+            manifest = {}
+
+        self.__manifest = manifest
+        self.__current: Dict[str, Dict[str, str]] = {}
+        self.__stats = IndexStats()
+        self.__batch: List[Tuple[str, str, Document]] = []
+        self.__collection_ready = not self.__drop_pending and self.__collection_exists()
+        self.__pool = ThreadPoolExecutor(max_workers=self.__upsert_workers) if self.__upsert_workers > 1 else None
+        self.__in_flight = set()
+
+        # the lexical index tracks the same point ids; if it drifted, it is refilled from every chunk seen
+        tracked = sum(len(chunks) for chunks in manifest.values())
+        self.__refill_lexical = (not self.__drop_pending and self.__lexical_index is not None
+                                 and self.__lexical_index.count() != tracked)
+        if self.__refill_lexical:
+            self.__lexical_index.clear()
+
+    def add(self, docs: List[Document]):
+        unchanged = []
+        for doc in docs:
+            source = doc.metadata.get("source", "")
+            text_hash = chunk_hash(doc.page_content)
+            seen = self.__current.setdefault(source, {})
+            if text_hash in seen:
+                continue
+
+            seen[text_hash] = point_id(source, text_hash)
+            if text_hash in self.__manifest.get(source, {}):
+                self.__stats.unchanged += 1
+                unchanged.append((seen[text_hash], doc))
+            else:
+                self.__batch.append((source, text_hash, doc))
+                if len(self.__batch) >= self.__batch_size:
+                    self.__flush()
+
+        if self.__refill_lexical and unchanged:
+            self.__lexical_index.add(unchanged)
+
+    def finish(self, kept_sources: Iterable[str] = (), keep_unseen: bool = False) -> IndexStats:
+        # sources not added again were removed from the site and lose their chunks, except kept_sources (pages
+        # that failed to load this time) or, with keep_unseen, all of them (a crawl cut short by max_pages)
+        self.__flush()
+        if self.__pool is not None:
+            for future in self.__in_flight:
+                future.result()
+            self.__pool.shutdown()
+            self.__pool = None
+
+        # nothing seen at all is a failed crawl rather than an empty site, the index is left as it was
+        if not self.__current:
+            return self.__stats
+
+        kept_sources = set(kept_sources)
+        manifest = dict(self.__current)
+        removed = []
+        for source, chunks in self.__manifest.items():
+            seen = self.__current.get(source)
+            if seen is None and (keep_unseen or source in kept_sources):
+                manifest[source] = chunks
+                continue
+            removed.extend(pid for text_hash, pid in chunks.items() if seen is None or text_hash not in seen)
+
+        if removed and self.__collection_exists():
+            self.__client.delete(collection_name=self.__collection_name,
+                                 points_selector=models.PointIdsList(points=removed))
+        self.__stats.removed = len(removed)
+
+        if self.__lexical_index is not None:
+            if removed:
+                self.__lexical_index.remove(removed)
+            self.__lexical_index.optimize()
+
+        self.__save_manifest(manifest)
+        tracer.count("ingest.chunks_added", self.__stats.added)
+        tracer.count("ingest.chunks_unchanged", self.__stats.unchanged)
+        tracer.count("ingest.chunks_removed", self.__stats.removed)
+        return self.__stats
+
+    def abort(self):
+        # the manifest is left as it was; if points were written they make it disagree with the collection,
+        # which the next begin() treats as a reason to rebuild
+        if self.__pool is not None:
+            self.__pool.shutdown(cancel_futures=True)
+            self.__pool = None
+
+    def __flush(self):
+        batch, self.__batch = self.__batch, []
+        if not batch:
+            return
+
+        # replacement chunks are here, the old collection and its lexical entries can go
+        if self.__drop_pending:
+            self.__drop_collection()
+            if self.__lexical_index is not None:
+                self.__lexical_index.clear()
+            self.__drop_pending = False
+
+        self.__stats.added += len(batch)
+        if self.__lexical_index is not None:
+            self.__lexical_index.add([(point_id(source, text_hash), doc) for source, text_hash, doc in batch])
+
+        # the first batch creates the collection, the rest can be written concurrently over the same client
+        if not self.__collection_ready:
+            self.__upsert(batch, create=True)
+            self.__collection_ready = True
+        elif self.__pool is None:
+            self.__upsert(batch)
+        else:
+            # bounded so a slow store holds back the producer instead of queueing every batch
+            while len(self.__in_flight) >= self.__upsert_workers * 2:
+                done, self.__in_flight = wait(self.__in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            self.__in_flight.add(self.__pool.submit(self.__upsert, batch))
+
+    def __create_collection(self, size: int):
+        options = self.__settings.create_options() if self.__settings is not None else {}
+        self.__client.recreate_collection(
+            collection_name=self.__collection_name,
+            vectors_config=models.VectorParams(size=size, distance=models.Distance.COSINE),
+            **options
+        )
+
+        # keyword indexes let qdrant filter and delete by source without scanning payloads
+        if self.__settings is not None:
+            for field_name in self.__settings.payload_indexes:
+                self.__client.create_payload_index(collection_name=self.__collection_name, field_name=field_name,
+                                                   field_schema=models.PayloadSchemaType.KEYWORD)
+
+    def __upsert(self, batch: List[Tuple[str, str, Document]], create: bool = False):
+        with tracer.span("ingest.embed", chunks=len(batch)):
+            vectors = self.__embeddings.embed_documents([doc.page_content for _, _, doc in batch])
+        if create:
+            self.__create_collection(len(vectors[0]))
+
+        points = [
+            models.PointStruct(
+                id=point_id(source, text_hash),
+                vector=vector,
+                payload={self.__content_payload_key: doc.page_content, self.__metadata_payload_key: doc.metadata}
+            )
+            for (source, text_hash, doc), vector in zip(batch, vectors)
+        ]
+        with tracer.span("ingest.upsert", chunks=len(points)):
+            self.__client.upsert(collection_name=self.__collection_name, points=points)
+
+    def __collection_exists(self) -> bool:
+        return collection_exists(self.__client, self.__collection_name)
+
+    def __drop_collection(self):
+        if self.__collection_exists():
+            self.__client.delete_collection(collection_name=self.__collection_name)
+
+    def __manifest_matches_collection(self, manifest: Dict[str, Dict[str, str]]) -> bool:
+        tracked = sum(len(chunks) for chunks in manifest.values())
+        if not self.__collection_exists():
+            return tracked == 0
+
+        return self.__client.count(collection_name=self.__collection_name, exact=True).count == tracked
+
+    def __load_manifest(self) -> Dict[str, Dict[str, str]]:
+        if not os.path.exists(self.__manifest_path):
+            return {}
+
+        try:
+            with open(self.__manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as error:
+            print(error)
+            return {}
+
+    def __save_manifest(self, manifest: Dict[str, Dict[str, str]]):
+        directory = os.path.dirname(self.__manifest_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        tmp_file = self.__manifest_path + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_file, self.__manifest_path)
@@ -0,0 +1,169 @@
+import os
+import time
+import queue
+import multiprocessing
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterator, List, Optional, Tuple
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.schema import Document
+from scraper import Scraper
+from indexer import IncrementalIndexer, IndexStats
+from tracing import tracer
+
+# marks the end of a stage's output on its queue
+DONE = object()
+
+
+def split_pages(pages: List[Tuple[str, dict]], chunk_size: int, chunk_overlap: int) -> List[Tuple[str, dict]]:
+    # runs in a worker process, so pages and chunks cross the boundary as plain tuples
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len,
+    )
+    docs = text_splitter.split_documents([Document(page_content=text, metadata=metadata) for text, metadata in pages])
+    return [(doc.page_content, doc.metadata) for doc in docs]
+
+
+def timed_split(pages: List[Tuple[str, dict]], chunk_size: int,
+                chunk_overlap: int) -> Tuple[List[Tuple[str, dict]], float]:
+    # worker processes have no tracer listeners, so the duration is sent back with the chunks
+    start = time.perf_counter()
+    chunks = split_pages(pages, chunk_size, chunk_overlap)
+    return chunks, time.perf_counter() - start
+
+
+class IngestPipeline:
+    def __init__(self, scraper: Scraper, indexer: IncrementalIndexer, chunk_size: int = 1000, chunk_overlap: int = 20,
+                 split_workers: Optional[int] = None, pages_per_task: int = 16, queue_size: int = 8,
+                 pool_min_pages: int = 2048):
+        self.__scraper = scraper
+        self.__indexer = indexer
+        self.__chunk_size = chunk_size
+        self.__chunk_overlap = chunk_overlap
+        self.__split_workers = split_workers if split_workers is not None else min(4, os.cpu_count() or 1)
+        self.__pages_per_task = max(1, pages_per_task)
+        # starting the worker processes costs over a second, about what splitting two thousand pages takes
+        self.__pool_min_pages = pool_min_pages
+        # bounded queues make a slow stage hold back the ones before it, so memory stays flat on large sites
+        self.__pages: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+        self.__chunks: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+        self.__stop = threading.Event()
+        self.__errors: List[BaseException] = []
+
+    def run(self, rebuild: bool = False) -> IndexStats:
+        # crawl, split and index overlap: chunks are embedded and upserted while later pages are still fetched
+        with tracer.span("ingest", rebuild=rebuild):
+            return self.__run(rebuild)
+
+    def __run(self, rebuild: bool) -> IndexStats:
+        self.__indexer.begin(rebuild=rebuild)
+        stages = [
+            threading.Thread(target=self.__stage, args=(self.__crawl,), name="ingest-crawl", daemon=True),
+            threading.Thread(target=self.__stage, args=(self.__split,), name="ingest-split", daemon=True),
+        ]
+        for stage in stages:
+            stage.start()
+
+        try:
+            for docs in self.__drain(self.__chunks):
+                self.__indexer.add(docs)
+        except BaseException as error:
+            self.__fail(error)
+        finally:
+            self.__stop.set()
+            for stage in stages:
+                stage.join()
+
+        # a failed run leaves the manifest untouched, so the next ingest does not delete chunks it never saw
+        if self.__errors:
+            self.__indexer.abort()
+            raise self.__errors[0]
+        # pages that failed to load keep their chunks unless the site says they are gone; when max_pages
+        # stopped the crawl, pages it did not get to may still exist
+        scraper = self.__scraper
+        return self.__indexer.finish(set(scraper.failed_urls) - scraper.gone_urls, keep_unseen=scraper.truncated)
+
+    def __stage(self, target):
+        try:
+            target()
+        except BaseException as error:
+            self.__fail(error)
+
+    def __fail(self, error: BaseException):
+        self.__errors.append(error)
+        self.__stop.set()
+
+    def __crawl(self):
+        batch = []
+        pages = self.__scraper.crawl_iter()
+        try:
+            for page in pages:
+                batch.append((page.page_content, page.metadata))
+                if len(batch) >= self.__pages_per_task:
+                    self.__put(self.__pages, batch)
+                    batch = []
+        finally:
+            # stops the crawl's fetch pool when a later stage failed
+            pages.close()
+        if batch:
+            self.__put(self.__pages, batch)
+        self.__put(self.__pages, DONE)
+
+    def __split(self):
+        # small crawls are split in this process; the pool is only started once enough pages have come in
+        split_pages_count = 0
+        executor: Optional[ProcessPoolExecutor] = None
+        in_flight = set()
+        try:
+            for pages in self.__drain(self.__pages):
+                if executor is None and (self.__split_workers <= 1 or split_pages_count < self.__pool_min_pages):
+                    split_pages_count += len(pages)
+                    self.__put_chunks(timed_split(pages, self.__chunk_size, self.__chunk_overlap))
+                    continue
+
+                # splitting is pure python, so large crawls run it on processes; in-flight tasks are bounded like
+                # the queues. workers are spawned, forking a process that already runs Qt and thread pools is not safe
+                if executor is None:
+                    executor = ProcessPoolExecutor(max_workers=self.__split_workers,
+                                                   mp_context=multiprocessing.get_context("spawn"))
+                if len(in_flight) >= self.__split_workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.__put_chunks(future.result())
+                in_flight.add(executor.submit(timed_split, pages, self.__chunk_size, self.__chunk_overlap))
+
+            for future in in_flight:
+                self.__put_chunks(future.result())
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self.__put(self.__chunks, DONE)
+
+    def __put_chunks(self, result: Tuple[List[Tuple[str, dict]], float]):
+        chunks, seconds = result
+        if tracer.enabled:
+            tracer.record("ingest.split", seconds, {"chunks": len(chunks)})
+            tracer.count("ingest.chunks", len(chunks))
+        self.__put(self.__chunks, [Document(page_content=text, metadata=metadata) for text, metadata in chunks])
+
+    def __put(self, target: queue.Queue, item):
+        while not self.__stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise InterruptedError("Ingest stopped")
+
+    def __drain(self, source: queue.Queue) -> Iterator:
+        while not self.__stop.is_set():
+            try:
+                item = source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is DONE:
+                return
+            yield item
+        raise InterruptedError("Ingest stopped")
@@ -0,0 +1,407 @@
+import os
+import json
+import uuid
+import threading
+import qdrant_client
+from qdrant_client.local.qdrant_local import QdrantLocal
+from qdrant_client.qdrant_remote import QdrantRemote
+from qdrant_client.http import models
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from langchain.schema import Document
+from langchain.vectorstores import Qdrant
+from scraper import Scraper
+from indexer import IncrementalIndexer, collection_exists
+from ingest import IngestPipeline
+from embeddings import CachedEmbeddings, EmbeddingCache
+from embedding_providers import embedding_provider_factory
+from answer_cache import AnswerCache
+from lexical_index import LexicalIndex
+from retrieval import Candidate
+from settings import CrawlSettings, EmbeddingSettings, StoreSettings
+from vector_store import NumpyVectorClient
+
+VECTOR_STORES = ("qdrant", "qdrant-server", "numpy")
+VectorClient = Union[qdrant_client.QdrantClient, NumpyVectorClient]
+# the embedding record is one point in a small collection next to the chunks, so every host using the store sees it
+EMBEDDING_RECORD_SUFFIX = "-embedding"
+EMBEDDING_RECORD_ID = str(uuid.uuid5(uuid.NAMESPACE_URL, "pychat:embedding-record"))
+
+
+class EmbeddingMismatchError(ValueError):
+    pass
+
+
+def close_client(client: VectorClient):
+    if isinstance(client, NumpyVectorClient):
+        client.close()
+        return
+
+    # qdrant-client 1.1 has no close(): the embedded client holds its folder lock and sqlite files until
+    # garbage collected, the server client its grpc channel and http connection pool
+    inner = getattr(client, "_client", None)
+    if isinstance(inner, QdrantLocal):
+        for collection in inner.collections.values():
+            if collection.storage is not None:
+                collection.storage.storage.close()
+        if inner._flock_file is not None:
+            inner._flock_file.close()
+            inner._flock_file = None
+    elif isinstance(inner, QdrantRemote):
+        if inner._grpc_channel is not None:
+            inner._grpc_channel.close()
+            inner._grpc_channel = None
+        inner.openapi_client.client._client.close()
+
+
+class KnowledgeBase:
+    def __init__(self, api_key: str, url: str, db_path: str, collection_name: str, client: VectorClient,
+                 crawl: CrawlSettings = None, embedding: EmbeddingSettings = None, store: StoreSettings = None,
+                 lexical_index: bool = False):
+        self.__api_key = api_key
+        self.__url = url
+        self.__db_path = db_path
+        self.__collection_name = collection_name
+        self.__client = client
+        self.__crawl = crawl if crawl is not None else CrawlSettings()
+        self.__embedding = embedding if embedding is not None else EmbeddingSettings()
+        self.__store_settings = store if store is not None else StoreSettings()
+        # answers depend on the engine's model and retrieval settings, so there is one cache per configuration
+        self.__answer_caches: Dict[Tuple, AnswerCache] = {}
+        self.__answer_caches_lock = threading.Lock()
+        self.__collection_settings = self.__store_settings.collection_settings()
+        search_params = self.__collection_settings.search_params() if self.__collection_settings is not None else None
+        self.__search_options = {"search_params": search_params} if search_params is not None else {}
+        self.__lexical_index = None
+        if lexical_index:
+            os.makedirs(db_path, exist_ok=True)
+            self.__lexical_index = LexicalIndex(os.path.join(db_path, collection_name + ".lexical.sqlite"))
+
+        self.__embedding_cache = EmbeddingCache(self.__embedding.cache_path) if self.__embedding.cache_path else None
+        self.__embeddings = self.__embeddings_factory()
+        self.__store = None
+
+    @property
+    def store(self) -> Qdrant:
+        return self.__store
+
+    @property
+    def client(self) -> VectorClient:
+        return self.__client
+
+    @property
+    def embeddings(self) -> CachedEmbeddings:
+        return self.__embeddings
+
+    def answer_cache(self, key: Tuple, factory: Callable[[], AnswerCache]) -> AnswerCache:
+        with self.__answer_caches_lock:
+            cache = self.__answer_caches.get(key)
+            if cache is None:
+                cache = self.__answer_caches[key] = factory()
+            return cache
+
+    @property
+    def lexical_index(self) -> Optional[LexicalIndex]:
+        return self.__lexical_index
+
+    def search(self, vector: List[float], k: int = 4) -> List[Document]:
+        results = self.__client.search(
+            collection_name=self.__collection_name,
+            query_vector=vector,
+            limit=k,
+            with_payload=True,
+            **self.__search_options
+        )
+        return [self.__document(result.payload) for result in results]
+
+    def search_with_vectors(self, vector: List[float], k: int = 20) -> List[Candidate]:
+        results = self.__client.search(
+            collection_name=self.__collection_name,
+            query_vector=vector,
+            limit=k,
+            with_payload=True,
+            with_vectors=True,
+            **self.__search_options
+        )
+        return [
+            Candidate(str(result.id), self.__document(result.payload), result.score, result.vector)
+            for result in results
+        ]
+
+    def lexical_search(self, query: str, k: int = 20) -> List[Candidate]:
+        if self.__lexical_index is None:
+            return []
+        return [Candidate(chunk_id, doc, score) for chunk_id, doc, score in self.__lexical_index.search(query, k)]
+
+    def attach_vectors(self, candidates: List[Candidate]) -> List[Candidate]:
+        missing = [candidate for candidate in candidates if candidate.vector is None]
+        if missing:
+            records = self.__client.retrieve(collection_name=self.__collection_name,
+                                             ids=[candidate.chunk_id for candidate in missing],
+                                             with_payload=False, with_vectors=True)
+            vectors = {str(record.id): record.vector for record in records}
+            for candidate in missing:
+                candidate.vector = vectors.get(candidate.chunk_id)
+        return candidates
+
+    def load(self, load_docs_from_source: bool = False) -> "KnowledgeBase":
+        # crawling and splitting only happen when the collection actually has to be (re)built
+        if load_docs_from_source or not collection_exists(self.__client, self.__collection_name):
+            self.__embed_source()
+        else:
+            self.__check_embedding_record()
+
+        if self.__lexical_index is not None:
+            self.__sync_lexical_index()
+
+        # the langchain wrapper only accepts a real qdrant client
+        if isinstance(self.__client, qdrant_client.QdrantClient):
+            self.__store = Qdrant(
+                client=self.__client, collection_name=self.__collection_name,
+                embedding_function=self.__embeddings.embed_query
+            )
+        return self
+
+    def close(self):
+        if self.__lexical_index is not None:
+            self.__lexical_index.close()
+        if self.__embedding_cache is not None:
+            self.__embedding_cache.close()
+        # only providers created here are closed, a provider instance passed in belongs to the caller
+        if isinstance(self.__embedding.provider, str):
+            self.__embeddings.provider.close()
+
+    def __embeddings_factory(self) -> CachedEmbeddings:
+        provider = self.__embedding.provider
+        if isinstance(provider, str):
+            provider = embedding_provider_factory(provider, self.__api_key, self.__embedding.batch_size,
+                                                  self.__embedding.options)
+        return CachedEmbeddings(
+            provider, provider.model, self.__embedding_cache,
+            batch_size=self.__embedding.batch_size,
+            max_concurrency=self.__embedding.concurrency
+        )
+
+    def __embed_source(self):
+        crawl = self.__crawl
+        scraper = Scraper(self.__url, max_pages=crawl.max_pages, workers=crawl.workers,
+                          per_host_limit=crawl.per_host_limit, delay=crawl.delay, timeout=crawl.timeout,
+                          checkpoint_path=crawl.checkpoint_path, cache_path=crawl.cache_path)
+        indexer = IncrementalIndexer(
+            self.__client, self.__collection_name, self.__embeddings,
+            manifest_path=os.path.join(self.__db_path, self.__collection_name + ".manifest.json"),
+            batch_size=self.__store_settings.upsert_batch_size,
+            lexical_index=self.__lexical_index,
+            settings=self.__collection_settings,
+            upsert_workers=self.__store_settings.parallel_upserts()
+        )
+        pipeline = IngestPipeline(scraper, indexer, chunk_size=crawl.chunk_size, chunk_overlap=crawl.chunk_overlap,
+                                  split_workers=crawl.split_workers)
+
+        # vectors from another provider cannot be mixed with new ones, so a changed provider forces a rebuild
+        rebuild = not (crawl.incremental and self.__embedding_record_matches())
+        pipeline.run(rebuild=rebuild)
+        self.__save_embedding_record()
+
+        # answers cached before the ingest may be based on stale chunks
+        with self.__answer_caches_lock:
+            for cache in self.__answer_caches.values():
+                cache.clear()
+
+
+    def __embedding_record_collection(self) -> str:
+        return self.__collection_name + EMBEDDING_RECORD_SUFFIX
+
+    def __legacy_embedding_record_path(self) -> str:
+        return os.path.join(self.__db_path, self.__collection_name + ".embedding.json")
+
+    def __current_embedding_record(self) -> Dict:
+        provider = self.__embeddings.provider
+        dimension = provider.dimension
+        if not dimension and collection_exists(self.__client, self.__collection_name):
+            dimension = self.__client.get_collection(self.__collection_name).config.params.vectors.size
+        return {"provider": provider.name, "model": provider.model, "dimension": dimension}
+
+    def __load_embedding_record(self) -> Optional[Dict]:
+        if collection_exists(self.__client, self.__embedding_record_collection()):
+            records = self.__client.retrieve(self.__embedding_record_collection(), ids=[EMBEDDING_RECORD_ID],
+                                             with_payload=True)
+            if records:
+                return records[0].payload
+        return self.__load_legacy_embedding_record()
+
+    def __load_legacy_embedding_record(self) -> Optional[Dict]:
+        # records used to be written next to the local database; they are moved into the store on the next save
+        if not os.path.exists(self.__legacy_embedding_record_path()):
+            return None
+
+        try:
+            with open(self.__legacy_embedding_record_path(), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as error:
+            print(error)
+            return None
+
+    def __save_embedding_record(self):
+        collection_name = self.__embedding_record_collection()
+        if not collection_exists(self.__client, collection_name):
+            self.__client.recreate_collection(
+                collection_name=collection_name,
+                vectors_config=models.VectorParams(size=1, distance=models.Distance.COSINE)
+            )
+        self.__client.upsert(collection_name=collection_name, points=[
+            models.PointStruct(id=EMBEDDING_RECORD_ID, vector=[1.0], payload=self.__current_embedding_record())
+        ])
+
+    def __embedding_record_matches(self) -> bool:
+        record = self.__load_embedding_record()
+        return record is None or record == self.__current_embedding_record()
+
+    def __check_embedding_record(self):
+        current = self.__current_embedding_record()
+        record = self.__load_embedding_record()
+        if record is None:
+            # collections from before the record existed are only checked on their vector size
+            record = dict(current, dimension=self.__client.get_collection(
+                self.__collection_name).config.params.vectors.size)
+            if record != current:
+                raise EmbeddingMismatchError(
+                    "Collection {} has {} dimensional vectors but {} embeds into {} dimensions".format(
+                        self.__collection_name, record["dimension"], current["model"], current["dimension"]))
+            self.__save_embedding_record()
+        elif record != current:
+            raise EmbeddingMismatchError(
+                "Collection {} was built with {}/{} ({} dimensions) but is opened with {}/{} ({} dimensions); "
+                "reload it from source to re-embed".format(
+                    self.__collection_name, record["provider"], record["model"], record["dimension"],
+                    current["provider"], current["model"], current["dimension"]))
+
+    def __sync_lexical_index(self):
+        # collections built before the lexical index existed are backfilled from the stored payloads
+        if not collection_exists(self.__client, self.__collection_name):
+            return
+        if self.__lexical_index.count() == self.__client.count(collection_name=self.__collection_name,
+                                                               exact=True).count:
+            return
+
+        self.__lexical_index.clear()
+        offset = None
+        while True:
+            records, offset = self.__client.scroll(collection_name=self.__collection_name, limit=256,
+                                                   offset=offset, with_payload=True, with_vectors=False)
+            self.__lexical_index.add([(str(record.id), self.__document(record.payload)) for record in records])
+            if offset is None:
+                break
+        self.__lexical_index.optimize()
+
+    @staticmethod
+    def __document(payload: dict) -> Document:
+        return Document(page_content=payload.get("page_content"), metadata=payload.get("metadata") or {})
+
+
+class RegistryEntry:
+    def __init__(self, key: Tuple[str, str, str, str], client_key: Tuple[str, str]):
+        self.key = key
+        self.client_key = client_key
+        self.knowledge_base: Optional[KnowledgeBase] = None
+        self.error: Optional[Exception] = None
+        self.ready = threading.Event()
+        self.refs = 0
+
+
+class KnowledgeBaseRegistry:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__entries: Dict[Tuple[str, str, str, str], RegistryEntry] = {}
+        # the embedded Qdrant client locks its folder, so there is one client per (vector store, db_path)
+        self.__clients: Dict[Tuple[str, str], List] = {}
+
+    def acquire(self, url: str, db_path: str, collection_name: str, factory: Callable[[VectorClient], KnowledgeBase],
+                store: StoreSettings = None, lexical_index: bool = False) -> KnowledgeBase:
+        store = store if store is not None else StoreSettings()
+        if store.vector_store not in VECTOR_STORES:
+            raise ValueError("Unknown vector store: {}".format(store.vector_store))
+        if store.vector_store == "qdrant-server" and not store.server_url:
+            raise ValueError("The qdrant-server vector store needs a server url")
+
+        # server clients are shared per server, so every session multiplexes over one grpc channel
+        client_key = (store.vector_store, store.server_url if store.vector_store == "qdrant-server" else db_path)
+        # the same collection name in another store or folder is another collection
+        key = (url, collection_name) + client_key
+        with self.__lock:
+            entry = self.__entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = RegistryEntry(key, client_key)
+                self.__entries[key] = entry
+            entry.refs += 1
+
+        # only the first caller builds the knowledge base, everyone else waits for it
+        if owner:
+            client = None
+            try:
+                client = self.__acquire_client(client_key, store.server_options)
+                entry.knowledge_base = factory(client)
+            except Exception as error:
+                entry.error = error
+                with self.__lock:
+                    self.__entries.pop(key, None)
+                    if client is not None:
+                        self.__release_client(client_key)
+                raise
+            finally:
+                entry.ready.set()
+        else:
+            entry.ready.wait()
+            if entry.error is not None:
+                raise entry.error
+            if lexical_index and entry.knowledge_base.lexical_index is None:
+                self.release(entry.knowledge_base)
+                raise ValueError("Collection {} is already open without a lexical index; open it with the same "
+                                 "retrieval mode or close the other sessions first".format(collection_name))
+
+        return entry.knowledge_base
+
+    def release(self, knowledge_base: KnowledgeBase):
+        with self.__lock:
+            entry = next((known for known in self.__entries.values() if known.knowledge_base is knowledge_base), None)
+            if entry is None:
+                return
+
+            entry.refs -= 1
+            if entry.refs == 0:
+                self.__entries.pop(entry.key)
+                # the knowledge base goes first, it may still flush to the client
+                knowledge_base.close()
+                self.__release_client(entry.client_key)
+
+    def __acquire_client(self, client_key: Tuple[str, str], server_options: dict = None) -> VectorClient:
+        with self.__lock:
+            if client_key not in self.__clients:
+                vector_store, location = client_key
+                if vector_store == "numpy":
+                    client = NumpyVectorClient(location)
+                elif vector_store == "qdrant-server":
+                    options = dict(server_options or {})
+                    options.setdefault("prefer_grpc", True)
+                    client = qdrant_client.QdrantClient(url=location, **options)
+                else:
+                    # prefer_grpc has no effect on the embedded client
+                    client = qdrant_client.QdrantClient(path=location)
+                self.__clients[client_key] = [client, 0]
+            self.__clients[client_key][1] += 1
+            return self.__clients[client_key][0]
+
+    def __release_client(self, client_key: Tuple[str, str]):
+        if client_key not in self.__clients:
+            return
+
+        self.__clients[client_key][1] -= 1
+        if self.__clients[client_key][1] == 0:
+            close_client(self.__clients.pop(client_key)[0])
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__entries)
+
+
+knowledge_bases = KnowledgeBaseRegistry()
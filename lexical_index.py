@@ -0,0 +1,105 @@
+import re
+import json
+import sqlite3
+import threading
+from typing import List, Tuple
+from langchain.schema import Document
+
+# identifiers such as load_qa_with_sources_chain stay single tokens
+TOKEN_PATTERN = re.compile(r"\w+")
+QUESTION_WORDS = {"what", "why", "how", "when", "where", "which", "who", "whom", "whose", "can", "could", "should",
+                  "would", "does", "do", "did", "is", "are", "explain", "describe", "tell"}
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z0-9]+(_|\.|::)[A-Za-z0-9_.:]+|[a-z]+[A-Z][A-Za-z0-9]*|\w+\(\)|`[^`]+`")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def is_keyword_query(query: str, max_terms: int = 4, max_identifier_context: int = 2) -> bool:
+    # only bare lookups skip embedding: an identifier with at most a word or two around it, or a short phrase.
+    # anything phrased as a question goes to hybrid, even when it mentions an identifier
+    terms = tokenize(query)
+    if not terms or query.strip().endswith("?") or any(term in QUESTION_WORDS for term in terms):
+        return False
+
+    if IDENTIFIER_PATTERN.search(query):
+        return len(tokenize(IDENTIFIER_PATTERN.sub(" ", query))) <= max_identifier_context
+    return len(terms) <= max_terms
+
+
+class LexicalIndex:
+    def __init__(self, path: str):
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+
+        # external content table: the text is stored once and fts5 only keeps the postings
+        self.__connection.executescript("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                rowid INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                page_content TEXT NOT NULL,
+                metadata TEXT NOT NULL
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
+                page_content, content='chunks', content_rowid='rowid', tokenize="unicode61 tokenchars '_'"
+            );
+            CREATE TRIGGER IF NOT EXISTS chunks_insert AFTER INSERT ON chunks BEGIN
+                INSERT INTO chunks_fts (rowid, page_content) VALUES (new.rowid, new.page_content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS chunks_delete AFTER DELETE ON chunks BEGIN
+                INSERT INTO chunks_fts (chunks_fts, rowid, page_content) VALUES ('delete', old.rowid, old.page_content);
+            END;
+        """)
+        self.__connection.commit()
+
+    def count(self) -> int:
+        with self.__lock:
+            return self.__connection.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def add(self, chunks: List[Tuple[str, Document]]):
+        rows = [(chunk_id, doc.page_content, json.dumps(doc.metadata)) for chunk_id, doc in chunks]
+        with self.__lock:
+            self.__connection.executemany("DELETE FROM chunks WHERE id = ?", [(row[0],) for row in rows])
+            self.__connection.executemany("INSERT INTO chunks (id, page_content, metadata) VALUES (?, ?, ?)", rows)
+            self.__connection.commit()
+
+    def remove(self, chunk_ids: List[str]):
+        with self.__lock:
+            self.__connection.executemany("DELETE FROM chunks WHERE id = ?", [(chunk_id,) for chunk_id in chunk_ids])
+            self.__connection.commit()
+
+    def clear(self):
+        with self.__lock:
+            self.__connection.execute("DELETE FROM chunks")
+            self.__connection.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('rebuild')")
+            self.__connection.commit()
+
+    def optimize(self):
+        with self.__lock:
+            self.__connection.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('optimize')")
+            self.__connection.commit()
+
+    def search(self, query: str, k: int = 20) -> List[Tuple[str, Document, float]]:
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        # any term may match, bm25 ranks documents matching more and rarer terms first
+        match = " OR ".join('"{}"'.format(term) for term in dict.fromkeys(terms))
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT chunks.id, chunks.page_content, chunks.metadata, bm25(chunks_fts) AS score "
+                "FROM chunks_fts JOIN chunks ON chunks.rowid = chunks_fts.rowid "
+                "WHERE chunks_fts MATCH ? ORDER BY score LIMIT ?", (match, k)
+            ).fetchall()
+
+        # sqlite's bm25 is negative with lower being better
+        return [(chunk_id, Document(page_content=content, metadata=json.loads(metadata)), -score)
+                for chunk_id, content, metadata, score in rows]
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
@@ -0,0 +1,117 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from pydantic import PrivateAttr
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.schema import BaseMessage
+from tracing import tracer
+
+# summaries are produced after the reply is returned; each memory has at most one summary in flight
+summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+
+
+class MemoryListener:
+    def messages_added(self, messages: List[BaseMessage]):
+        pass
+
+    def summary_changed(self, summary: str, pruned: int):
+        pass
+
+
+class SessionMemory(ConversationSummaryBufferMemory):
+    _listener: MemoryListener = PrivateAttr(default_factory=MemoryListener)
+    _lock: threading.RLock = PrivateAttr(default_factory=threading.RLock)
+    # token count of each buffered message, aligned with chat_memory.messages
+    _token_counts: List[int] = PrivateAttr(default_factory=list)
+    _pending: Optional[Future] = PrivateAttr(default=None)
+    # bumped by restore/clear so a summary of messages that are gone is discarded
+    _generation: int = PrivateAttr(default=0)
+
+    def set_listener(self, listener: MemoryListener):
+        self._listener = listener if listener is not None else MemoryListener()
+
+    def restore(self, summary: str, messages: List[BaseMessage]):
+        with self._lock:
+            self._generation += 1
+            self.moving_summary_buffer = summary
+            self.chat_memory.messages = list(messages)
+            self._token_counts = [self.__count(message) for message in messages]
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            return super().load_memory_variables(inputs)
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        with self._lock:
+            before = len(self.chat_memory.messages)
+            BaseChatMemory.save_context(self, inputs, outputs)
+            added = self.chat_memory.messages[before:]
+            self._token_counts.extend(self.__count(message) for message in added)
+
+        self._listener.messages_added(added)
+        self.__schedule_summary()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            super().clear()
+            self._token_counts = []
+
+    def buffer_tokens(self) -> int:
+        with self._lock:
+            return sum(self._token_counts)
+
+    def flush(self, timeout: float = None):
+        # waits for background summaries, including any that a finished summary scheduled
+        while True:
+            pending = self._pending
+            if pending is None:
+                return
+            pending.result(timeout)
+            if self._pending is pending:
+                return
+
+    def __schedule_summary(self):
+        with self._lock:
+            if self._pending is not None or sum(self._token_counts) <= self.max_token_limit:
+                return
+
+            # the oldest messages stay in the buffer until their summary is ready
+            total = sum(self._token_counts)
+            pruned = 0
+            while total > self.max_token_limit and pruned < len(self._token_counts):
+                total -= self._token_counts[pruned]
+                pruned += 1
+
+            messages = self.chat_memory.messages[:pruned]
+            summary = self.moving_summary_buffer
+            generation = self._generation
+            self._pending = summary_executor.submit(self.__summarize, messages, summary, generation)
+
+    def __summarize(self, messages: List[BaseMessage], summary: str, generation: int):
+        try:
+            with tracer.span("memory.summarize", messages=len(messages)):
+                new_summary = self.predict_new_summary(messages, summary)
+        except Exception as error:
+            print("Conversation summary failed: {}".format(error))
+            with self._lock:
+                self._pending = None
+            return
+
+        with self._lock:
+            self._pending = None
+            if generation != self._generation:
+                return
+
+            tracer.count("memory.summarized_messages", len(messages))
+            del self.chat_memory.messages[:len(messages)]
+            del self._token_counts[:len(messages)]
+            self.moving_summary_buffer = new_summary
+
+        self._listener.summary_changed(new_summary, len(messages))
+        # turns taken while summarizing may have pushed the buffer over the limit again
+        self.__schedule_summary()
+
+    def __count(self, message: BaseMessage) -> int:
+        return self.llm.get_num_tokens_from_messages([message])
@@ -1,13 +1,20 @@
 import sys
 import os
+import html
+import threading
+from collections import deque
 from enum import Enum
-from PyQt5.QtCore import Qt, QEvent, pyqtSignal, QObject, QThread
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QTextEdit, \
-    QLineEdit, QPushButton, QListWidget, QSizePolicy, QDialog, QLabel, QMessageBox
-from PyQt5.QtGui import QPalette
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from PyQt5.QtCore import Qt, QEvent, pyqtSignal, QObject, QRunnable, QThreadPool, QTimer, QAbstractListModel, \
+    QModelIndex, QSize, QPoint, QRectF
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QListView, QAbstractItemView, \
+    QStyledItemDelegate, QLineEdit, QPushButton, QListWidget, QSizePolicy, QDialog, QLabel, QMessageBox
+from PyQt5.QtGui import QPalette, QTextDocument
 
 from dotenv import load_dotenv
-from ai import OpenAIChat, OpenAISitemapWebSearch
+from ai import OpenAIChat, default_engine
+from chat_client import RemoteChatEngine, RemoteSessionStore
+from session_store import SessionStore
 
 
 prompt_template = """
@@ -27,6 +34,8 @@ If there is a URL in the reply format the reply with an <A> HTML tag.
 Start the conversation by introducing yourself.
 """
 
+SESSION_STORE_PATH = "./pychat.sqlite"
+
 SessionListChangedEventType = Enum('SessionListChangedEventType', ['Add', 'Remove'])
 
 
@@ -82,6 +91,14 @@ class SessionlistWidget(QWidget):
         self.sessionList.itemSelectionChanged.connect(self.trigger_session_item_changed)
         self.left_panel_layout.addWidget(self.sessionList)
 
+    def load_sessions(self, names):
+        for name in names:
+            self.sessionList.addItem(name)
+
+        if self.sessionList.count() > 0:
+            self.remove_button.setDisabled(False)
+            QApplication.postEvent(self.__chat_widget, AnyActiveSessionsEvent(False))
+
     def trigger_session_item_changed(self):
         self.__session_item_changed_handler(self.sessionList)
 
@@ -168,35 +185,441 @@ class AddSessionDialog(QDialog):
     def session_dialog_cancel_click(self):
         self.reject()
 
+USER_MESSAGE_TEMPLATE = """
+<span style="color:#c0c0c0;padding-bottom:3px"><B>You: </B> {message}</span><br></br>
+"""
+AI_MESSAGE_TEMPLATE = """
+<span style="color:#87CEEB;padding-bottom:3px"><B>AI: </B>{message}</span>
+"""
+
+MessageRole = Enum('MessageRole', ['User', 'AI'])
+
+
+class ChatMessage:
+    def __init__(self, role: MessageRole, text: str, streaming: bool = False):
+        self.role = role
+        self.text = text
+        self.streaming = streaming
+        # laid out the first time the message is on screen and reused until the text changes;
+        # height is the (width, height) of that layout
+        self.document: Optional[QTextDocument] = None
+        self.document_stale = True
+        self.height: Optional[Tuple[int, int]] = None
+
+    def changed(self):
+        self.document_stale = True
+        self.height = None
+
+    def html(self) -> str:
+        if self.role == MessageRole.User:
+            return USER_MESSAGE_TEMPLATE.format(message=self.text)
+
+        # a reply is plain text while it streams and formatted html once it is complete
+        message = html.escape(self.text) if self.streaming else self.text
+        return AI_MESSAGE_TEMPLATE.format(message=message)
+
+
+class TranscriptModel(QAbstractListModel):
+    def __init__(self):
+        super().__init__()
+        self.__messages: List[ChatMessage] = []
+
+    @property
+    def messages(self) -> List[ChatMessage]:
+        return self.__messages
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.__messages)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        message = self.__messages[index.row()]
+        if role == Qt.DisplayRole:
+            return message.html()
+        elif role == Qt.UserRole:
+            return message
+        return None
+
+    def add_message(self, role: MessageRole, text: str, streaming: bool = False):
+        row = len(self.__messages)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.__messages.append(ChatMessage(role, text, streaming))
+        self.endInsertRows()
+
+    def append_token(self, token: str):
+        reply = self.__streaming_reply()
+        if reply is None:
+            self.add_message(MessageRole.AI, token, streaming=True)
+            return
+
+        reply.text += token
+        self.__message_changed(len(self.__messages) - 1)
+
+    def finish_reply(self, text: str):
+        reply = self.__streaming_reply()
+        if reply is None:
+            self.add_message(MessageRole.AI, text)
+            return
+
+        reply.text = text
+        reply.streaming = False
+        self.__message_changed(len(self.__messages) - 1)
+
+    def streamed_text(self) -> str:
+        reply = self.__streaming_reply()
+        return reply.text if reply is not None else ""
+
+    def load(self, messages: List[Tuple[MessageRole, str]]):
+        self.beginResetModel()
+        self.__messages = [ChatMessage(role, text) for role, text in messages]
+        self.endResetModel()
+
+    def clear(self):
+        self.beginResetModel()
+        self.__messages = []
+        self.endResetModel()
+
+    def __streaming_reply(self) -> Optional[ChatMessage]:
+        if self.__messages and self.__messages[-1].streaming:
+            return self.__messages[-1]
+        return None
+
+    def __message_changed(self, row: int):
+        self.__messages[row].changed()
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
+
+
+class MessageDelegate(QStyledItemDelegate):
+    # padding added to estimated heights for the margins of the message templates
+    ESTIMATE_PADDING = 24
+
+    def __init__(self, view: QListView):
+        super().__init__(view)
+        self.__view = view
+        self.__visible_rows = range(0)
+
+    def paint(self, painter, option, index):
+        document = self.__document(index.data(Qt.UserRole), option.rect.width())
+        painter.save()
+        painter.translate(option.rect.topLeft())
+        # the row may still have its estimated height until the view asks for the exact one
+        document.drawContents(painter, QRectF(0, 0, option.rect.width(), option.rect.height()))
+        painter.restore()
+
+    def sizeHint(self, option, index):
+        message = index.data(Qt.UserRole)
+        width = self.__view.viewport().width()
+        if self.__is_exact(message, width):
+            return QSize(width, message.height[1])
+
+        # the view asks for every row; only those on screen are laid out, the rest get an estimate
+        if index.row() not in self.__visible_rows:
+            return QSize(width, self.__estimated_height(message, width))
+
+        height = int(self.__document(message, width).size().height())
+        message.height = (width, height)
+        return QSize(width, height)
+
+    def show_rows(self, rows: range) -> List[int]:
+        # returns the rows that are now visible but still sized by an estimate
+        self.__visible_rows = rows
+        model = self.__view.model()
+        width = self.__view.viewport().width()
+        return [row for row in rows if not self.__is_exact(model.index(row).data(Qt.UserRole), width)]
+
+    @staticmethod
+    def __is_exact(message: ChatMessage, width: int) -> bool:
+        return message.height is not None and message.height[0] == width
+
+    def __estimated_height(self, message: ChatMessage, width: int) -> int:
+        # a layout at another width scales with the number of wrapped lines, otherwise the lines are counted
+        if message.height is not None:
+            measured_width, measured_height = message.height
+            return max(1, measured_height * measured_width // max(1, width))
+
+        metrics = self.__view.fontMetrics()
+        chars_per_line = max(1, width // max(1, metrics.averageCharWidth()))
+        lines = sum(len(line) // chars_per_line + 1 for line in message.text.split("\n"))
+        return lines * metrics.lineSpacing() + self.ESTIMATE_PADDING
+
+    @staticmethod
+    def __document(message: ChatMessage, width: int) -> QTextDocument:
+        # a width change only re-wraps the cached document, new text is set on the same one
+        if message.document is None:
+            message.document = QTextDocument()
+        if message.document_stale:
+            message.document.setHtml(message.html())
+            message.document.setTextWidth(width)
+            message.document_stale = False
+        elif message.document.textWidth() != width:
+            message.document.setTextWidth(width)
+        return message.document
+
+
+class TranscriptView(QListView):
+    def __init__(self):
+        super().__init__()
+
+        self.__delegate = MessageDelegate(self)
+        self.setItemDelegate(self.__delegate)
+        self.setSelectionMode(QAbstractItemView.NoSelection)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setResizeMode(QListView.Adjust)
+        self.setUniformItemSizes(False)
+        self.setWordWrap(True)
+
+        # rows that come into view get their exact height once scrolling and resizing settle
+        self.__visible_timer = QTimer(self)
+        self.__visible_timer.setSingleShot(True)
+        self.__visible_timer.setInterval(30)
+        self.__visible_timer.timeout.connect(self.__update_visible_rows)
+        self.__follow_bottom = False
+        self.verticalScrollBar().valueChanged.connect(lambda value: self.__visible_timer.start())
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.__visible_timer.start()
+
+    def setModel(self, model):
+        previous = self.model()
+        if previous is not None:
+            previous.rowsInserted.disconnect(self.__rows_inserted)
+            previous.dataChanged.disconnect(self.__data_changed)
+
+        super().setModel(model)
+        model.rowsInserted.connect(self.__rows_inserted)
+        model.dataChanged.connect(self.__data_changed)
+        self.scrollToBottom()
+        self.__follow_bottom = True
+        self.__visible_timer.start()
+
+    def __at_bottom(self) -> bool:
+        scroll_bar = self.verticalScrollBar()
+        return scroll_bar.value() >= scroll_bar.maximum() - 4
+
+    def __rows_inserted(self, parent, first, last):
+        if self.__at_bottom():
+            QTimer.singleShot(0, self.scrollToBottom)
+        self.__visible_timer.start()
+
+    def __update_visible_rows(self):
+        model = self.model()
+        if model is None or model.rowCount() == 0:
+            return
+
+        first = self.indexAt(QPoint(0, 0)).row()
+        last = self.indexAt(QPoint(0, self.viewport().height() - 1)).row()
+        rows = range(max(0, first), (last if last >= 0 else model.rowCount() - 1) + 1)
+        estimated = self.__delegate.show_rows(rows)
+        if not estimated:
+            if self.__follow_bottom:
+                self.__follow_bottom = False
+                self.scrollToBottom()
+            return
+
+        # exact heights move the rows below, so the visible range is checked again after the relayout
+        self.__follow_bottom = self.__follow_bottom or self.__at_bottom()
+        for row in estimated:
+            self.__delegate.sizeHintChanged.emit(model.index(row))
+        self.__visible_timer.start()
+
+    def __data_changed(self, top_left, bottom_right, roles=None):
+        follow = self.__at_bottom()
+        self.__delegate.sizeHintChanged.emit(top_left)
+        if follow:
+            QTimer.singleShot(0, self.scrollToBottom)
+
+
 class SessionContainer:
     key: str
-    ai_engine: OpenAIChat
-    history: []
+    # both are loaded the first time the session is selected
+    ai_engine: Optional[Union[OpenAIChat, RemoteChatEngine]] = None
+    transcript: Optional[TranscriptModel] = None
+
+
+class QueryCancelled(Exception):
+    pass
+
 
-class ChatWorker(QThread):
-    finished = pyqtSignal(str)
+class QueryRequest:
+    def __init__(self, request_id: int, session_key: str, engine: OpenAIChat, message: str):
+        self.request_id = request_id
+        self.session_key = session_key
+        self.engine = engine
+        self.message = message
+        self.cancelled = threading.Event()
 
-    def __init__(self, session, message):
+
+class QuerySignals(QObject):
+    token = pyqtSignal(str, int, str)
+    finished = pyqtSignal(str, int, str)
+    failed = pyqtSignal(str, int, str)
+    # emitted last by every runnable, once it no longer uses the engine
+    done = pyqtSignal(str, int)
+
+
+class QueryRunnable(QRunnable):
+    def __init__(self, request: QueryRequest, signals: QuerySignals):
         super().__init__()
 
-        self.__session = session
-        self.__message = message
+        self.__request = request
+        self.__signals = signals
 
     def run(self):
-        response = self.__session.query(self.__message)
-        self.finished.emit(response)
+        request = self.__request
+
+        # raising from the token callback aborts the streaming request
+        def on_token(token):
+            if request.cancelled.is_set():
+                raise QueryCancelled()
+            self.__signals.token.emit(request.session_key, request.request_id, token)
+
+        try:
+            response = request.engine.query(request.message, on_token=on_token)
+            self.__signals.finished.emit(request.session_key, request.request_id, response)
+        except QueryCancelled:
+            pass
+        except Exception as error:
+            print(error)
+            self.__signals.failed.emit(request.session_key, request.request_id, str(error))
+        finally:
+            self.__signals.done.emit(request.session_key, request.request_id)
+
+
+class QueryScheduler(QObject):
+    token = pyqtSignal(str, int, str)
+    finished = pyqtSignal(str, int, str)
+    failed = pyqtSignal(str, int, str)
+
+    def __init__(self, max_workers: int = 4, timeout_ms: int = 120000):
+        super().__init__()
+
+        self.__pool = QThreadPool()
+        self.__pool.setMaxThreadCount(max_workers)
+        self.__timeout_ms = timeout_ms
+        self.__next_request_id = 0
+
+        # sessions run in parallel, messages within a session run one after another. A cancelled or timed out
+        # request stays running until its runnable returns, so the engine is never used by two threads
+        self.__queues: Dict[str, deque] = {}
+        self.__running: Dict[str, QueryRequest] = {}
+        # called instead of starting the next request once the session's runnable has returned
+        self.__idle_callbacks: Dict[str, List[Callable[[], None]]] = {}
+
+        # worker threads emit on these, the slots below then run on the UI thread
+        self.__signals = QuerySignals()
+        self.__signals.token.connect(self.__on_token)
+        self.__signals.finished.connect(self.__on_finished)
+        self.__signals.failed.connect(self.__on_failed)
+        self.__signals.done.connect(self.__on_done)
+
+    def submit(self, session_key: str, engine: OpenAIChat, message: str) -> int:
+        self.__next_request_id += 1
+        request = QueryRequest(self.__next_request_id, session_key, engine, message)
+        self.__queues.setdefault(session_key, deque()).append(request)
+        if session_key not in self.__running:
+            self.__start_next(session_key)
+
+        return request.request_id
+
+    def is_busy(self, session_key: str) -> bool:
+        return session_key in self.__running
+
+    def cancel(self, session_key: str, on_idle: Callable[[], None] = None):
+        # on_idle runs once nothing uses the session's engine any more, right away when it is idle
+        for request in self.__queues.pop(session_key, deque()):
+            self.failed.emit(session_key, request.request_id, "Cancelled")
+
+        request = self.__running.get(session_key)
+        if request is not None and not request.cancelled.is_set():
+            request.cancelled.set()
+            self.failed.emit(session_key, request.request_id, "Cancelled")
+
+        if on_idle is not None:
+            if request is None:
+                on_idle()
+            else:
+                self.__idle_callbacks.setdefault(session_key, []).append(on_idle)
+
+    def shutdown(self, wait_ms: int = 5000):
+        for session_key in list(self.__queues) + list(self.__running):
+            self.cancel(session_key)
+        self.__pool.waitForDone(wait_ms)
+
+    def __start_next(self, session_key: str):
+        queue = self.__queues.get(session_key)
+        if not queue:
+            self.__queues.pop(session_key, None)
+            return
+
+        request = queue.popleft()
+        self.__running[session_key] = request
+        self.__pool.start(QueryRunnable(request, self.__signals))
+
+        if self.__timeout_ms > 0:
+            QTimer.singleShot(self.__timeout_ms, lambda: self.__on_timeout(session_key, request.request_id))
+
+    def __is_current(self, session_key: str, request_id: int) -> bool:
+        # a cancelled request may still be running, but nothing it reports is shown any more
+        request = self.__running.get(session_key)
+        return request is not None and request.request_id == request_id and not request.cancelled.is_set()
+
+    def __on_token(self, session_key: str, request_id: int, token: str):
+        if self.__is_current(session_key, request_id):
+            self.token.emit(session_key, request_id, token)
+
+    def __on_finished(self, session_key: str, request_id: int, response: str):
+        if self.__is_current(session_key, request_id):
+            self.finished.emit(session_key, request_id, response)
+
+    def __on_failed(self, session_key: str, request_id: int, error: str):
+        if self.__is_current(session_key, request_id):
+            self.failed.emit(session_key, request_id, error)
+
+    def __on_timeout(self, session_key: str, request_id: int):
+        if self.__is_current(session_key, request_id):
+            self.__running[session_key].cancelled.set()
+            self.failed.emit(session_key, request_id, "Timed out")
+
+    def __on_done(self, session_key: str, request_id: int):
+        request = self.__running.get(session_key)
+        if request is None or request.request_id != request_id:
+            return
+
+        del self.__running[session_key]
+        for on_idle in self.__idle_callbacks.pop(session_key, []):
+            on_idle()
+        self.__start_next(session_key)
+
 
 class ChatWindow(QWidget):
-    def __init__(self):
+    def __init__(self, session_store_path=SESSION_STORE_PATH, server_url: str = None, server_user: str = None):
         super().__init__()
 
+        # with a server url the window is a client of server.py instead of running the engines itself
+        self.__server_url = server_url
+        self.__server_user = server_user or "default"
+
         self.any_active_sessions_event_signal = pyqtSignal(bool)
         self.session_list_changed_event_signal = pyqtSignal(SessionListChangedEventType, str)
 
         self.__sessions = dict()
         self.__selected_session = None
-        self.__message_worker = None
+        self.__empty_transcript = TranscriptModel()
+        # the server keeps the sessions and transcripts of its clients, nothing is written locally then
+        if server_url:
+            self.__store = RemoteSessionStore(server_url, self.__server_user)
+        else:
+            self.__store = SessionStore(session_store_path)
 
+        self.__scheduler = QueryScheduler()
+        self.__scheduler.token.connect(self.handle_ai_token)
+        self.__scheduler.finished.connect(self.handle_ai_message)
+        self.__scheduler.failed.connect(self.handle_ai_error)
 
         # Set the window title and size
         self.setWindowTitle("pychat")
@@ -218,8 +641,8 @@ class ChatWindow(QWidget):
         chat_layout = QVBoxLayout()
 
         # Create the chat history widget
-        self.history = QTextEdit()
-        self.history.setReadOnly(True)
+        self.history = TranscriptView()
+        self.history.setModel(self.__empty_transcript)
 
         chat_layout.addWidget(self.history)
 
@@ -240,14 +663,36 @@ class ChatWindow(QWidget):
         chat_layout.addWidget(self.clear_button)
         self.clear_button.clicked.connect(self.clear_history)
 
+        # Create the cancel button widget
+        self.cancel_button = QPushButton("Cancel")
+        chat_layout.addWidget(self.cancel_button)
+        self.cancel_button.clicked.connect(self.cancel_message)
+
         layout.addLayout(chat_layout)
 
         # Initialize the counter for new items
         self.item_counter = 1
 
+        # only the session names are read at startup
+        for key in self.__store.list_sessions():
+            container = SessionContainer()
+            container.key = key
+            self.__sessions[key] = container
+        self.checklist.load_sessions(self.__sessions.keys())
+
     def clear_history(self):
-        self.history.clear()
-        self.__selected_session.history = ""
+        if self.__selected_session is not None:
+            self.__selected_session.transcript.clear()
+            self.__store.clear_messages(self.__selected_session.key)
+
+    def cancel_message(self):
+        if self.__selected_session is not None:
+            self.__scheduler.cancel(self.__selected_session.key)
+
+    def closeEvent(self, event):
+        self.__scheduler.shutdown()
+        self.__store.close()
+        super().closeEvent(event)
 
     def session_list_selection_changed_handler(self, list: QListWidget):
         print("session_list_selection_changed_handler invoked")
@@ -256,17 +701,10 @@ class ChatWindow(QWidget):
         #    self.__selected_session = None
 
         for item in selected_items:
-            # save history window text
-            old_session = None
-            if self.__selected_session is not None:
-                self.__sessions[self.__selected_session.key].history = self.history.toHtml()
-                # self.__selected_session.history = self.history.toHtml()
-
+            # every session keeps its own transcript model, switching just swaps the model
             self.__selected_session = self.__sessions[item.text()]
-
-            # restore session text
-            #if len(self.__selected_session.history) != 0:
-            self.history.setHtml(self.__selected_session.history)
+            self.load_session(self.__selected_session)
+            self.history.setModel(self.__selected_session.transcript)
 
     def event(self, event):
         if event.type() == AnyActiveSessionsEvent.Type:
@@ -282,71 +720,93 @@ class ChatWindow(QWidget):
 
     def session_list_changed_handler(self, change_type, name):
         if change_type == SessionListChangedEventType.Add:
-            api_key = os.getenv('OPENAI_KEY')
+            self.__store.add_session(name)
             container = SessionContainer()
             container.key = name
-            # container.ai_engine = OpenAIChat("gpt-3.5-turbo", api_key, temp=0.5)
-            container.ai_engine = OpenAISitemapWebSearch(
-                model_name="gpt-3.5-turbo",
-                api_key=api_key,
-                # url="https://python.langchain.com/en/latest/index.html",
-                url="https://medium.com/slope-stories/slopegpt-the-first-payments-risk-model-powered-by-gpt-4-cd444ab5242d",
-                db_path="./vector_db",
-                collection_name="medium-slopegpt",
-                filter_urls=["https://python.langchain.com/en/latest/"],
-                temp=0.5,
-                load_docs_from_source=True,
-                max_pages=1
-            )
-
-            container.history = ""
             self.__sessions[name] = container
             self.checklist.select_session(self.checklist.sessionList.count() - 1)
+            self.load_session(container)
 
             # Send prompt through
             #self.add_user_message(prompt_template)
             #self.input.clear()
-            self.set_message_controls_disabled(True)
-            self.__message_worker = ChatWorker(self.__selected_session.ai_engine, prompt_template)
-            self.__message_worker.finished.connect(self.handle_ai_message)
-            self.__message_worker.start()
+            self.__scheduler.submit(name, container.ai_engine, prompt_template)
 
         else:
-            self.__sessions.pop(name)
+            container = self.__sessions.pop(name)
+            # the engine is closed only after a reply still running on it has returned
+            self.__scheduler.cancel(name, container.ai_engine.close if container.ai_engine is not None else None)
+            try:
+                self.__store.remove_session(name)
+            except Exception as error:
+                print(error)
+            if container is self.__selected_session:
+                self.__selected_session = None
+                self.history.setModel(self.__empty_transcript)
+
+    def engine_factory(self, session_key: str):
+        if self.__server_url:
+            return RemoteChatEngine(self.__server_url, self.__server_user, session_key)
+        return default_engine()
+
+    def load_session(self, container):
+        if container.transcript is None:
+            messages = self.__store.load_messages(container.key)
+            container.transcript = TranscriptModel()
+            container.transcript.load([(MessageRole[role], text) for role, text in messages])
+
+        if container.ai_engine is None:
+            container.ai_engine = self.engine_factory(container.key)
+            if self.__server_url:
+                return
+
+            summary, buffer = self.__store.load_memory(container.key)
+            container.ai_engine.conversation_buffer.restore(summary, buffer)
+            container.ai_engine.memory_listener = self.__store.memory_writer(container.key)
 
     def add_user_message(self, msg):
-        self.history.append(
-            """
-            <span style="color:#c0c0c0;padding-bottom:3px"><B>You: </B> {message}</span><br></br>
-            """.format(message=msg)
-        )
+        self.__selected_session.transcript.add_message(MessageRole.User, msg)
+        self.__store.append_message(self.__selected_session.key, MessageRole.User.name, msg)
+
     def add_ai_message(self, msg):
-        self.history.append(
-            """
-            <span style="color:#87CEEB;padding-bottom:3px"><B>AI: </B>{message}</span>
-            """.format(message=msg)
-        )
+        self.__selected_session.transcript.add_message(MessageRole.AI, msg)
+        self.__store.append_message(self.__selected_session.key, MessageRole.AI.name, msg)
 
     def set_message_controls_disabled(self, state):
         self.input.setDisabled(state)
         self.send_button.setDisabled(state)
         self.clear_button.setDisabled(state)
+        self.cancel_button.setDisabled(state)
+
+    def handle_ai_token(self, session_key, request_id, token):
+        container = self.__sessions.get(session_key)
+        if container is not None:
+            container.transcript.append_token(token)
+
+    def handle_ai_message(self, session_key, request_id, response):
+        container = self.__sessions.get(session_key)
+        if container is not None:
+            container.transcript.finish_reply(response)
+            self.__store.append_message(session_key, MessageRole.AI.name, response)
 
-    def handle_ai_message(self, response):
-        self.set_message_controls_disabled(False)
-        self.add_ai_message(response)
+    def handle_ai_error(self, session_key, request_id, error):
+        container = self.__sessions.get(session_key)
+        if container is None:
+            return
+
+        # keep whatever was streamed before the request failed
+        streamed = html.escape(container.transcript.streamed_text().rstrip())
+        container.transcript.finish_reply("{} <i>({})</i>".format(streamed, error).strip())
 
     def send_message(self):
         # Get the user input and clear the input widget
         message = self.input.text().strip()
+        if not message or self.__selected_session is None:
+            return
 
         self.add_user_message(message)
         self.input.clear()
-        self.set_message_controls_disabled(True)
-
-        self.__message_worker = ChatWorker(self.__selected_session.ai_engine, message)
-        self.__message_worker.finished.connect(self.handle_ai_message)
-        self.__message_worker.start()
+        self.__scheduler.submit(self.__selected_session.key, self.__selected_session.ai_engine, message)
 
     def set_chat_disabled(self, state):
         self.set_message_controls_disabled(state)
@@ -357,7 +817,7 @@ if __name__ == "__main__":
         # Create the application and chat widget
         load_dotenv()
         app = QApplication(sys.argv)
-        chat_widget = ChatWindow()
+        chat_widget = ChatWindow(server_url=os.getenv('PYCHAT_SERVER'), server_user=os.getenv('PYCHAT_USER'))
 
         # Show the chat widget and start the application event loop
         chat_widget.show()
@@ -0,0 +1,150 @@
+import re
+import hashlib
+import numpy as np
+from typing import Callable, Dict, List, Optional, Set
+from langchain.schema import Document
+from tracing import tracer
+
+# tokens of retrieved context allowed in the prompt, leaving room for the question and the answer
+CONTEXT_TOKEN_BUDGETS = {
+    "gpt-3.5-turbo": 1500,
+    "text-davinci-003": 1500,
+    "gpt-4": 3000,
+    "gpt-4-32k": 12000,
+}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 1500
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class Candidate:
+    def __init__(self, chunk_id: str, document: Document, score: float, vector: Optional[List[float]] = None):
+        self.chunk_id = chunk_id
+        self.document = document
+        self.score = score
+        self.vector = vector
+
+
+def reciprocal_rank_fusion(rankings: List[List[Candidate]], k: int = 60) -> List[Candidate]:
+    # scores from bm25 and cosine similarity are not comparable, ranks are
+    fused: Dict[str, Candidate] = {}
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, candidate in enumerate(ranking):
+            scores[candidate.chunk_id] = scores.get(candidate.chunk_id, 0.0) + 1.0 / (k + rank + 1)
+            known = fused.get(candidate.chunk_id)
+            if known is None or (known.vector is None and candidate.vector is not None):
+                fused[candidate.chunk_id] = candidate
+
+    ordered = sorted(scores, key=scores.get, reverse=True)
+    return [Candidate(chunk_id, fused[chunk_id].document, scores[chunk_id], fused[chunk_id].vector)
+            for chunk_id in ordered]
+
+
+def model_token_budget(model_name: str) -> int:
+    for prefix in sorted(CONTEXT_TOKEN_BUDGETS, key=len, reverse=True):
+        if model_name.startswith(prefix):
+            return CONTEXT_TOKEN_BUDGETS[prefix]
+    return DEFAULT_CONTEXT_TOKEN_BUDGET
+
+
+def shingles(text: str, size: int = 5) -> Set[int]:
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < size:
+        return {hash(" ".join(words))}
+    return {hash(" ".join(words[i:i + size])) for i in range(len(words) - size + 1)}
+
+
+def overlap(a: Set[int], b: Set[int]) -> float:
+    # overlap coefficient rather than jaccard, so a chunk contained in a longer one counts as a duplicate
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0)
+
+
+def mmr(relevance: np.ndarray, vectors: np.ndarray, k: int, diversity: float = 0.5) -> List[int]:
+    if len(vectors) == 0:
+        return []
+
+    vectors = normalize_rows(vectors)
+    similarity = vectors @ vectors.T
+
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarity[selected[0]].copy()
+    while len(selected) < min(k, len(vectors)):
+        scores = (1 - diversity) * relevance - diversity * redundancy
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        redundancy = np.maximum(redundancy, similarity[best])
+    return selected
+
+
+class ContextPacker:
+    def __init__(self, count_tokens: Callable[[str], int], token_budget: int, k: int = 8,
+                 diversity: float = 0.5, duplicate_threshold: float = 0.8):
+        self.__count_tokens = count_tokens
+        self.__token_budget = token_budget
+        self.__k = k
+        self.__diversity = diversity
+        self.__duplicate_threshold = duplicate_threshold
+
+    @property
+    def token_budget(self) -> int:
+        return self.__token_budget
+
+    def pack(self, candidates: List[Candidate]) -> List[Document]:
+        candidates = self.__drop_duplicates(candidates)
+        if not candidates:
+            return []
+
+        # without vectors (lexical results) the ranking is kept as is
+        if all(candidate.vector is not None for candidate in candidates):
+            relevance = np.asarray([candidate.score for candidate in candidates], dtype=np.float32)
+            top = relevance.max()
+            order = mmr(relevance / top if top > 0 else relevance,
+                        np.asarray([candidate.vector for candidate in candidates], dtype=np.float32),
+                        len(candidates), self.__diversity)
+        else:
+            order = range(len(candidates))
+
+        # fill the budget in ranked order, skipping chunks that no longer fit
+        packed = []
+        remaining = self.__token_budget
+        for index in order:
+            doc = candidates[index].document
+            tokens = self.__count_tokens(doc.page_content)
+            if tokens > remaining:
+                continue
+            packed.append(doc)
+            remaining -= tokens
+            if len(packed) == self.__k:
+                break
+
+        tracer.count("retrieval.context_tokens", self.__token_budget - remaining)
+        return packed
+
+    def __drop_duplicates(self, candidates: List[Candidate]) -> List[Candidate]:
+        # candidates arrive best first, so the higher ranked copy of a duplicate is kept
+        kept = []
+        kept_shingles = []
+        seen_hashes = set()
+        for candidate in candidates:
+            doc = candidate.document
+            digest = hashlib.sha256(doc.page_content.strip().encode("utf-8")).hexdigest()
+            if digest in seen_hashes:
+                continue
+
+            doc_shingles = shingles(doc.page_content)
+            if any(overlap(doc_shingles, other) >= self.__duplicate_threshold for other in kept_shingles):
+                continue
+
+            seen_hashes.add(digest)
+            kept_shingles.append(doc_shingles)
+            kept.append(candidate)
+        return kept
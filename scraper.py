@@ -1,72 +1,263 @@
+import time
+import threading
 import requests
-from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 from urllib.parse import urlparse
 from urllib.parse import urljoin
-from bs4 import BeautifulSoup
+import lxml.html
+from lxml import etree
+from requests.adapters import HTTPAdapter
 from langchain.schema import Document
+from frontier import CrawlFrontier, CrawlCheckpoint, normalize_url
+from http_cache import ResponseCache
+from tracing import tracer
+
+# elements that never hold page content
+BOILERPLATE_TAGS = ["script", "style", "noscript", "template", "svg"]
+# page chrome, dropped only when it is not part of the main content
+LAYOUT_TAGS = ["nav", "header", "footer", "aside", "form"]
+MAIN_CONTENT_XPATH = "//main | //article | //*[@role='main']"
+BLOCK_TAGS = ["p", "div", "section", "article", "main", "h1", "h2", "h3", "h4", "h5", "h6", "li", "dt", "dd", "pre",
+              "blockquote", "table", "tr", "br"]
+# statuses meaning the page was removed, as opposed to failing to load this time
+GONE_STATUSES = {404, 410}
+
+
+def extract_page(content: bytes) -> Tuple[List[str], str]:
+    root = lxml.html.fromstring(content)
+    links = [href for href in root.xpath("//a/@href") if not href.startswith("#")]
+
+    etree.strip_elements(root, *BOILERPLATE_TAGS, with_tail=False)
+
+    # every outermost match is kept, so sibling <article>s all count but nested ones are not emitted twice
+    # an <article> teaser inside a sidebar or site header is not the page's content
+    candidates = [node for node in root.xpath(MAIN_CONTENT_XPATH)
+                  if not any(ancestor.tag in LAYOUT_TAGS for ancestor in node.iterancestors())]
+    matched = set(candidates)
+    nodes = [node for node in candidates if not any(ancestor in matched for ancestor in node.iterancestors())]
+    if not nodes:
+        body = root.find(".//body")
+        nodes = [body if body is not None else root]
+        for node in nodes:
+            etree.strip_elements(node, *LAYOUT_TAGS, with_tail=False)
+
+    lines = []
+    for node in nodes:
+        # keep block boundaries so adjacent headings and paragraphs don't run together
+        for element in node.iter(*BLOCK_TAGS):
+            element.tail = "\n" + (element.tail or "")
+        lines.extend(" ".join(line.split()) for line in node.text_content().splitlines())
+    return links, "\n".join(line for line in lines if line)
+
+
+class CrawlError(Exception):
+    pass
 
 
 class Scraper:
-    def __init__(self, start_url: str, max_pages: int = 0):
+    def __init__(self, start_url: str, max_pages: int = 0, workers: int = 1, per_host_limit: int = 4,
+                 delay: float = 0.0, timeout: float = 30.0, checkpoint_path: Optional[str] = None,
+                 checkpoint_every: int = 100, cache_path: Optional[str] = None):
         self.__url: str = start_url
-        self.__seen: List[str] = []
+        self.__frontier = CrawlFrontier()
         self.__pages: List[Document] = []
         self.__max_pages = max_pages
-        self.__hostname = urlparse(start_url).netloc
+        self.__hostname = urlparse(normalize_url(start_url)).netloc
+        self.__workers = max(1, workers)
+        self.__per_host_limit = max(1, per_host_limit)
+        self.__delay = delay
+        self.__timeout = timeout
+        self.__checkpoint = CrawlCheckpoint(checkpoint_path) if checkpoint_path else None
+        self.__checkpoint_every = max(1, checkpoint_every)
+        self.__page_count = 0
+        # pages fetched since the last checkpoint save
+        self.__unsaved: List[Document] = []
+        self.__cache = ResponseCache(cache_path) if cache_path else None
+        # url -> reason for every page that could not be fetched in the last crawl
+        self.__failed_urls: Dict[str, str] = {}
+        self.__gone_urls: Set[str] = set()
+        self.__truncated = False
+
+        self.__session: Optional[requests.Session] = None
+        self.__host_lock = threading.Lock()
+        self.__host_slots: Dict[str, threading.BoundedSemaphore] = {}
+        self.__host_next_request: Dict[str, float] = {}
 
     @property
     def pages(self) -> List[Document]:
         return self.__pages
 
+    @property
+    def failed_urls(self) -> Dict[str, str]:
+        return self.__failed_urls
+
+    @property
+    def truncated(self) -> bool:
+        # max_pages stopped the last crawl before the frontier ran out
+        return self.__truncated
+
+    @property
+    def gone_urls(self) -> Set[str]:
+        # pages that answered 404 or 410, their content can be dropped from an index
+        return self.__gone_urls
+
     def crawl(self):
+        self.__pages = list(self.crawl_iter())
+
+    def crawl_iter(self) -> Iterator[Document]:
+        # pages are yielded as they arrive and not kept; fetching pauses while the consumer is busy
         if not self.__valid_url(self.__url):
             raise ValueError("Invalid URL")
 
-        self.__crawl_page(self.__url)
+        self.__frontier = CrawlFrontier()
+        self.__page_count = 0
+        self.__unsaved = []
+        self.__failed_urls = {}
+        self.__gone_urls = set()
+        self.__truncated = False
+        if self.__checkpoint is not None and self.__checkpoint.exists():
+            self.__frontier, self.__page_count = self.__checkpoint.load()
+            print("Resuming crawl from {} with {} pages".format(self.__checkpoint.path, self.__page_count))
+            yield from self.__checkpoint.pages()
+        else:
+            self.__enqueue(self.__url)
+
+        # one keep-alive pool shared by every worker
+        with self.__session_factory() as session:
+            self.__session = session
+            try:
+                yield from self.__crawl_frontier()
+            finally:
+                self.__session = None
+
+        # a dead or unreachable site must not look like an empty one
+        if self.__page_count == 0 and self.__failed_urls:
+            url, reason = next(iter(self.__failed_urls.items()))
+            raise CrawlError("Could not crawl {}: {}".format(url, reason))
+
+        if self.__checkpoint is not None:
+            self.__checkpoint.clear()
 
+    def __session_factory(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.__per_host_limit,
+                              pool_maxsize=max(self.__workers, self.__per_host_limit))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
 
-    def __crawl_page(self, url: str):
+    def __crawl_frontier(self) -> Iterator[Document]:
+        pending = {}
+
+        with ThreadPoolExecutor(max_workers=self.__workers) as pool:
+            while self.__frontier or pending:
+                # in-flight requests count towards max_pages so the limit is never overshot
+                while self.__frontier and len(pending) < self.__workers and not self.__limit_reached(len(pending)):
+                    url = self.__frontier.pop()
+                    pending[pool.submit(self.__fetch, url)] = url
+
+                if not pending:
+                    self.__truncated = bool(self.__frontier)
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url = pending.pop(future)
+                    links, doc = future.result()
+                    if doc is None:
+                        continue
+
+                    self.__page_count += 1
+                    if self.__checkpoint is not None:
+                        self.__unsaved.append(doc)
+                    for link in links:
+                        self.__enqueue(link)
+                    yield doc
+
+                if self.__checkpoint is not None and len(self.__unsaved) >= self.__checkpoint_every:
+                    self.__checkpoint.save(self.__frontier, pending.values(), self.__unsaved, self.__page_count)
+                    self.__unsaved = []
+
+    def __enqueue(self, url: str):
         if not self.__valid_url(url):
             print("Invalid url: " + url)
             return
 
-        if url not in self.__seen and self.__hostname == urlparse(url).netloc:
-            links, doc = self.__get_pages(url)
-            self.__pages.append(doc)
-            self.__seen.append(url)
+        try:
+            if self.__hostname == urlparse(normalize_url(url)).netloc:
+                self.__frontier.push(url)
+        except ValueError as error:
+            print(error)
 
-            # check if there's a page limit
-            if self.__max_pages > 0 and len(self.__pages) >= self.__max_pages:
-                return
+    def __limit_reached(self, in_flight: int = 0) -> bool:
+        return self.__max_pages > 0 and self.__page_count + in_flight >= self.__max_pages
 
-            for link in links:
-                if len(self.__pages) >= self.__max_pages:
-                    break
+    def __fetch(self, url: str) -> Tuple[List[str], Optional[Document]]:
+        host = urlparse(normalize_url(url)).netloc
+        with self.__host_slot(host):
+            self.__throttle(host)
+            return self.__get_pages(url)
+
+    def __host_slot(self, host: str) -> threading.BoundedSemaphore:
+        with self.__host_lock:
+            if host not in self.__host_slots:
+                self.__host_slots[host] = threading.BoundedSemaphore(self.__per_host_limit)
+            return self.__host_slots[host]
 
-                absolute = self.__abs_url(url, link)
-                self.__crawl_page(absolute)
+    def __throttle(self, host: str):
+        if self.__delay <= 0:
+            return
 
+        # reserve the next request slot for this host, then wait for it outside the lock
+        with self.__host_lock:
+            now = time.monotonic()
+            start = max(now, self.__host_next_request.get(host, now))
+            self.__host_next_request[host] = start + self.__delay
+
+        if start > now:
+            time.sleep(start - now)
 
     def __abs_url(self, base_url: str, url: str):
         return requests.compat.urljoin(base_url, url)
 
-    def __get_pages(self, url: str) -> tuple[list[str], Document]:
+    def __get_pages(self, fetch_url: str) -> Tuple[List[str], Optional[Document]]:
         links: List[str] = []
-        docs: List[Document] = []
+        doc = None
+        # pages are recorded under the normalized url, so /guide and /guide/ are one source
+        url = normalize_url(fetch_url)
 
         try:
-            with requests.Session() as req:
-                r = req.get(url)
-                linkSoup = BeautifulSoup(r.content, 'html.parser')
-                links = [item["href"] for item in linkSoup.find_all("a", href=True)]
-                links = list(filter(lambda lnk: '#' not in lnk, links))
+            cached = self.__cache.get(url) if self.__cache is not None else None
+            headers = cached.conditional_headers if cached is not None else None
+            with tracer.span("crawl.fetch"):
+                r = self.__session.get(fetch_url, timeout=self.__timeout, headers=headers)
+
+            # unchanged since the last crawl, reuse the extracted page without parsing it again.
+            # links resolve against the url that answered, after redirects
+            if r.status_code == 304 and cached is not None:
+                tracer.count("http_cache.hits")
+                return [self.__abs_url(r.url, link) for link in cached.links], cached.document
+            if self.__cache is not None:
+                tracer.count("http_cache.misses")
 
-                contentSoup = BeautifulSoup(r.content, 'html.parser')
-                content_list = [item.text for item in contentSoup.select("div")]
-                content = ''.join(content_list)
-                doc = Document(page_content=content, metadata={'source': url})
+            r.raise_for_status()
+            tracer.count("crawl.bytes", len(r.content))
+            with tracer.span("crawl.extract"):
+                links, content = extract_page(r.content)
+            doc = Document(page_content=content, metadata={'source': url})
+            tracer.count("crawl.pages")
+
+            if self.__cache is not None:
+                self.__cache.put(url, r.headers.get("ETag"), r.headers.get("Last-Modified"), links, doc)
+            links = [self.__abs_url(r.url, link) for link in links]
 
         except Exception as error:
+            tracer.count("crawl.errors")
+            self.__failed_urls[url] = str(error)
+            response = error.response if isinstance(error, requests.HTTPError) else None
+            if response is not None and response.status_code in GONE_STATUSES:
+                self.__gone_urls.add(url)
             print(error)
 
         return links, doc
@@ -81,6 +272,3 @@ class Scraper:
             print(error)
 
         return is_valid
-
-
-
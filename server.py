@@ -0,0 +1,415 @@
+import json
+import asyncio
+import argparse
+import threading
+from urllib.parse import quote
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import AsyncIterator, Callable, Dict
+from aiohttp import web, WSMsgType
+from dotenv import load_dotenv
+from ai import OpenAIChat, default_engine
+from chat_client import USER_HEADER
+from session_store import SessionStore
+from tracing import MetricsCollector, tracer
+
+# tokens a reply may run ahead of its client before the engine waits
+TOKEN_BUFFER = 64
+
+
+class ReplyCancelled(Exception):
+    pass
+
+
+class ServiceUnavailable(Exception):
+    pass
+
+
+class ChatSession:
+    def __init__(self, key: str, engine: OpenAIChat):
+        self.key = key
+        self.engine = engine
+        # replies within a session are strictly ordered
+        self.lock = asyncio.Lock()
+        self.active = 0
+        # set when the session is removed; cancels the running reply and any queued behind it
+        self.removed = threading.Event()
+
+
+class ChatService:
+    def __init__(self, engine_factory: Callable[[], OpenAIChat], store: SessionStore, max_concurrency: int = 8,
+                 max_pending: int = 64, max_sessions: int = 256, reply_timeout: float = 120.0):
+        self.__engine_factory = engine_factory
+        self.__store = store
+        self.__max_pending = max_pending
+        self.__max_sessions = max(1, max_sessions)
+        self.__reply_timeout = reply_timeout
+
+        # engine calls block, so they run on a pool no larger than the number of replies allowed at once
+        self.__executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="engine")
+        self.__semaphore = asyncio.Semaphore(max_concurrency)
+        self.__sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self.__loading: Dict[str, asyncio.Future] = {}
+        self.__pending = 0
+        self.__idle = asyncio.Event()
+        self.__idle.set()
+        self.__closing = False
+
+    @property
+    def pending(self) -> int:
+        return self.__pending
+
+    @staticmethod
+    def session_key(user: str, name: str) -> str:
+        # the user is escaped, so one user's name prefix never matches another's sessions ("a" and "a/b")
+        return "{}/{}".format(quote(user, safe=""), name)
+
+    def list_sessions(self, user: str):
+        prefix = self.session_key(user, "")
+        return [key[len(prefix):] for key in self.__store.list_sessions() if key.startswith(prefix)]
+
+    def transcript(self, user: str, name: str):
+        return [{"role": role, "text": text}
+                for role, text in self.__store.load_messages(self.session_key(user, name))]
+
+    async def create_session(self, user: str, name: str):
+        self.__store.add_session(self.session_key(user, name))
+        await self.__session(self.session_key(user, name))
+
+    def clear_transcript(self, user: str, name: str):
+        self.__store.clear_messages(self.session_key(user, name))
+
+    async def remove_session(self, user: str, name: str):
+        key = self.session_key(user, name)
+        session = self.__sessions.pop(key, None)
+        if session is not None:
+            # the engine is closed only after the running reply gave the session lock back
+            session.removed.set()
+            async with session.lock:
+                await asyncio.get_running_loop().run_in_executor(self.__executor, session.engine.close)
+        self.__store.remove_session(key)
+
+    async def reply(self, user: str, name: str, message: str) -> AsyncIterator[dict]:
+        if self.__closing:
+            raise ServiceUnavailable("The server is shutting down")
+        # beyond max_pending the client is told to back off instead of queueing without bound
+        if self.__pending >= self.__max_pending:
+            raise ServiceUnavailable("Too many pending requests")
+
+        self.__pending += 1
+        self.__idle.clear()
+        try:
+            key = self.session_key(user, name)
+            self.__store.add_session(key)
+            session = await self.__session(key)
+            session.active += 1
+            try:
+                async with session.lock:
+                    if session.removed.is_set():
+                        yield {"type": "error", "error": "The session was removed"}
+                        return
+                    async with self.__semaphore:
+                        async for event in self.__stream(session, message):
+                            yield event
+            finally:
+                session.active -= 1
+        finally:
+            self.__pending -= 1
+            if self.__pending == 0:
+                self.__idle.set()
+
+    async def __stream(self, session: ChatSession, message: str) -> AsyncIterator[dict]:
+        loop = asyncio.get_running_loop()
+        tokens: asyncio.Queue = asyncio.Queue(maxsize=TOKEN_BUFFER)
+        cancelled = threading.Event()
+        done = object()
+
+        # blocks the engine thread while the buffer is full, so a slow client slows the completion down
+        def put(item) -> bool:
+            pending = asyncio.run_coroutine_threadsafe(tokens.put(item), loop)
+            while True:
+                try:
+                    pending.result(timeout=0.1)
+                    return True
+                except FutureTimeoutError:
+                    if cancelled.is_set() or session.removed.is_set():
+                        pending.cancel()
+                        return False
+
+        # raising from the token callback aborts the streaming request
+        def on_token(token: str):
+            if cancelled.is_set() or session.removed.is_set() or not put(token):
+                raise ReplyCancelled()
+
+        def query():
+            try:
+                return session.engine.query(message, on_token)
+            finally:
+                put(done)
+
+        self.__store.append_message(session.key, "User", message)
+        # marks the exception as retrieved, a cancelled reply's error is never looked at otherwise
+        def finished(future: asyncio.Future):
+            if not future.cancelled():
+                future.exception()
+
+        future = loop.run_in_executor(self.__executor, query)
+        future.add_done_callback(finished)
+        deadline = loop.time() + self.__reply_timeout
+        try:
+            while True:
+                token = await asyncio.wait_for(tokens.get(), max(0.0, deadline - loop.time()))
+                if token is done:
+                    break
+                yield {"type": "token", "token": token}
+
+            try:
+                response = future.result()
+            except ReplyCancelled:
+                return
+            except Exception as error:
+                print(error)
+                yield {"type": "error", "error": str(error)}
+                return
+
+            self.__store.append_message(session.key, "AI", response)
+            yield {"type": "done", "response": response}
+        except asyncio.TimeoutError:
+            yield {"type": "error", "error": "Request timed out"}
+        finally:
+            # the client went away, timed out or the server is stopping. The engine call is waited for, so the
+            # session lock is only given back once nothing uses the engine any more
+            if not future.done():
+                cancelled.set()
+                await asyncio.wait([future])
+
+    async def __session(self, key: str) -> ChatSession:
+        session = self.__sessions.get(key)
+        if session is not None:
+            self.__sessions.move_to_end(key)
+            return session
+
+        # concurrent first requests for a session share one engine load
+        loading = self.__loading.get(key)
+        if loading is None:
+            loading = asyncio.get_running_loop().run_in_executor(self.__executor, self.__load_engine, key)
+            self.__loading[key] = loading
+            try:
+                engine = await loading
+            finally:
+                self.__loading.pop(key, None)
+            session = ChatSession(key, engine)
+            self.__sessions[key] = session
+            await self.__evict(keep=key)
+            return session
+
+        await loading
+        return self.__sessions[key]
+
+    def __load_engine(self, key: str) -> OpenAIChat:
+        engine = self.__engine_factory()
+        summary, buffer = self.__store.load_memory(key)
+        engine.conversation_buffer.restore(summary, buffer)
+        engine.memory_listener = self.__store.memory_writer(key)
+        return engine
+
+    async def __evict(self, keep: str):
+        # idle engines are dropped first; their memory is in the store and is restored on the next request
+        loop = asyncio.get_running_loop()
+        for key in list(self.__sessions.keys()):
+            if len(self.__sessions) <= self.__max_sessions:
+                break
+            session = self.__sessions[key]
+            if key != keep and session.active == 0 and not session.lock.locked():
+                del self.__sessions[key]
+                await loop.run_in_executor(self.__executor, session.engine.close)
+
+    async def shutdown(self, grace_period: float = 30.0):
+        self.__closing = True
+        try:
+            await asyncio.wait_for(self.__idle.wait(), grace_period)
+        except asyncio.TimeoutError:
+            print("{} replies still running at shutdown".format(self.__pending))
+
+    def close(self):
+        for session in self.__sessions.values():
+            session.engine.close()
+        self.__sessions.clear()
+        self.__executor.shutdown(wait=False)
+        self.__store.close()
+
+
+def user_of(request: web.Request) -> str:
+    return request.headers.get(USER_HEADER, "default")
+
+
+async def list_sessions(request: web.Request) -> web.Response:
+    return web.json_response({"sessions": request.app["service"].list_sessions(user_of(request))})
+
+
+async def create_session(request: web.Request) -> web.Response:
+    await request.app["service"].create_session(user_of(request), request.match_info["name"])
+    return web.json_response({"session": request.match_info["name"]}, status=201)
+
+
+async def remove_session(request: web.Request) -> web.Response:
+    await request.app["service"].remove_session(user_of(request), request.match_info["name"])
+    return web.Response(status=204)
+
+
+async def clear_messages(request: web.Request) -> web.Response:
+    request.app["service"].clear_transcript(user_of(request), request.match_info["name"])
+    return web.Response(status=204)
+
+
+async def get_messages(request: web.Request) -> web.Response:
+    service = request.app["service"]
+    return web.json_response({"messages": service.transcript(user_of(request), request.match_info["name"])})
+
+
+async def post_message(request: web.Request) -> web.StreamResponse:
+    body = await request.json()
+    message = (body.get("message") or "").strip()
+    if not message:
+        return web.json_response({"error": "message is required"}, status=400)
+
+    service = request.app["service"]
+    events = service.reply(user_of(request), request.match_info["name"], message)
+    try:
+        first = await events.__anext__()
+    except ServiceUnavailable as error:
+        return web.json_response({"error": str(error)}, status=503, headers={"Retry-After": "1"})
+    except StopAsyncIteration:
+        first = None
+
+    # one json event per line; awaiting each write holds the engine back once the reply's token buffer is full
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    try:
+        if first is not None:
+            await response.write((json.dumps(first) + "\n").encode("utf-8"))
+            async for event in events:
+                await response.write((json.dumps(event) + "\n").encode("utf-8"))
+        await response.write_eof()
+    except ConnectionResetError:
+        # the client hung up; closing the generator below cancels the reply
+        pass
+    finally:
+        await events.aclose()
+    return response
+
+
+async def session_socket(request: web.Request) -> web.WebSocketResponse:
+    service = request.app["service"]
+    user, name = user_of(request), request.match_info["name"]
+    socket = web.WebSocketResponse(heartbeat=30)
+    await socket.prepare(request)
+    request.app["sockets"].add(socket)
+
+    async def send_reply(message: str):
+        try:
+            async for event in service.reply(user, name, message):
+                await socket.send_json(event)
+        except ServiceUnavailable as error:
+            await socket.send_json({"type": "error", "error": str(error)})
+
+    # replies run as tasks so the socket keeps reading and can receive a cancel
+    replies = set()
+    try:
+        async for msg in socket:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            data = json.loads(msg.data)
+            if data.get("type") == "cancel":
+                for task in replies:
+                    task.cancel()
+            elif data.get("message"):
+                task = asyncio.ensure_future(send_reply(data["message"]))
+                replies.add(task)
+                task.add_done_callback(replies.discard)
+    finally:
+        for task in replies:
+            task.cancel()
+        request.app["sockets"].discard(socket)
+    return socket
+
+
+async def metrics(request: web.Request) -> web.Response:
+    collector = request.app["metrics"]
+    if request.query.get("format") == "json":
+        return web.json_response(collector.snapshot())
+    return web.Response(text=collector.prometheus(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def health(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok", "pending": request.app["service"].pending})
+
+
+def create_app(engine_factory: Callable[[], OpenAIChat] = default_engine, store_path: str = "./pychat-server.sqlite",
+               max_concurrency: int = 8, max_pending: int = 64, max_sessions: int = 256,
+               reply_timeout: float = 120.0, grace_period: float = 30.0,
+               metrics_enabled: bool = False) -> web.Application:
+    app = web.Application()
+    app["sockets"] = set()
+    # spans and counters are only collected while something listens to the tracer
+    if metrics_enabled:
+        app["metrics"] = MetricsCollector()
+        tracer.add_listener(app["metrics"])
+
+    async def start(app: web.Application):
+        app["service"] = ChatService(engine_factory, SessionStore(store_path), max_concurrency=max_concurrency,
+                                     max_pending=max_pending, max_sessions=max_sessions,
+                                     reply_timeout=reply_timeout)
+
+    # stop taking requests, let running replies finish, then close sockets and engines
+    async def shutdown(app: web.Application):
+        await app["service"].shutdown(grace_period)
+        for socket in list(app["sockets"]):
+            await socket.close(code=1001, message=b"Server shutdown")
+
+    async def cleanup(app: web.Application):
+        app["service"].close()
+        if metrics_enabled:
+            tracer.remove_listener(app["metrics"])
+
+    app.on_startup.append(start)
+    app.on_shutdown.append(shutdown)
+    app.on_cleanup.append(cleanup)
+    app.add_routes([
+        web.get("/health", health),
+        web.get("/sessions", list_sessions),
+        web.put("/sessions/{name}", create_session),
+        web.delete("/sessions/{name}", remove_session),
+        web.get("/sessions/{name}/messages", get_messages),
+        web.post("/sessions/{name}/messages", post_message),
+        web.delete("/sessions/{name}/messages", clear_messages),
+        web.get("/sessions/{name}/socket", session_socket),
+    ])
+    if metrics_enabled:
+        app.add_routes([web.get("/metrics", metrics)])
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="headless pychat server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--store", default="./pychat-server.sqlite")
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--max-pending", type=int, default=64)
+    parser.add_argument("--max-sessions", type=int, default=256)
+    parser.add_argument("--reply-timeout", type=float, default=120.0)
+    parser.add_argument("--grace-period", type=float, default=30.0)
+    parser.add_argument("--metrics", action="store_true", help="expose stage timings and counters on /metrics")
+    args = parser.parse_args()
+
+    load_dotenv()
+    app = create_app(store_path=args.store, max_concurrency=args.max_concurrency, max_pending=args.max_pending,
+                     max_sessions=args.max_sessions, reply_timeout=args.reply_timeout,
+                     grace_period=args.grace_period, metrics_enabled=args.metrics)
+    web.run_app(app, host=args.host, port=args.port, shutdown_timeout=args.grace_period)
+
+
+if __name__ == "__main__":
+    main()
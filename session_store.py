@@ -0,0 +1,118 @@
+import time
+import sqlite3
+import threading
+from typing import List, Tuple
+from langchain.schema import AIMessage, BaseMessage, HumanMessage
+from memory import MemoryListener
+
+
+class SessionMemoryWriter(MemoryListener):
+    def __init__(self, store: "SessionStore", session_key: str):
+        self.__store = store
+        self.__session_key = session_key
+
+    def messages_added(self, messages: List[BaseMessage]):
+        for message in messages:
+            kind = "human" if isinstance(message, HumanMessage) else "ai"
+            self.__store.append_memory_event(self.__session_key, kind, message.content)
+
+    def summary_changed(self, summary: str, pruned: int):
+        self.__store.append_memory_event(self.__session_key, "summary", summary, pruned)
+
+
+class SessionStore:
+    def __init__(self, path: str):
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+
+        # transcript and memory are append-only logs; only the session list is read at startup
+        self.__connection.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                key TEXT PRIMARY KEY,
+                created REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_key TEXT NOT NULL,
+                role TEXT NOT NULL,
+                text TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_session ON messages (session_key, id);
+            CREATE TABLE IF NOT EXISTS memory_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_key TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                text TEXT NOT NULL,
+                pruned INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS memory_events_session ON memory_events (session_key, id);
+        """)
+        self.__connection.commit()
+
+    def list_sessions(self) -> List[str]:
+        with self.__lock:
+            rows = self.__connection.execute("SELECT key FROM sessions ORDER BY created").fetchall()
+        return [key for key, in rows]
+
+    def add_session(self, session_key: str):
+        self.__write("INSERT OR IGNORE INTO sessions (key, created) VALUES (?, ?)", (session_key, time.time()))
+
+    def remove_session(self, session_key: str):
+        with self.__lock:
+            for table, column in (("sessions", "key"), ("messages", "session_key"),
+                                  ("memory_events", "session_key")):
+                self.__connection.execute("DELETE FROM {} WHERE {} = ?".format(table, column), (session_key,))
+            self.__connection.commit()
+
+    def append_message(self, session_key: str, role: str, text: str):
+        self.__write("INSERT INTO messages (session_key, role, text, created) VALUES (?, ?, ?, ?)",
+                     (session_key, role, text, time.time()))
+
+    def load_messages(self, session_key: str) -> List[Tuple[str, str]]:
+        with self.__lock:
+            return self.__connection.execute(
+                "SELECT role, text FROM messages WHERE session_key = ? ORDER BY id", (session_key,)
+            ).fetchall()
+
+    def clear_messages(self, session_key: str):
+        self.__write("DELETE FROM messages WHERE session_key = ?", (session_key,))
+
+    def append_memory_event(self, session_key: str, kind: str, text: str, pruned: int = 0):
+        self.__write("INSERT INTO memory_events (session_key, kind, text, pruned, created) VALUES (?, ?, ?, ?, ?)",
+                     (session_key, kind, text, pruned, time.time()))
+
+    def load_memory(self, session_key: str) -> Tuple[str, List[BaseMessage]]:
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT kind, text, pruned FROM memory_events WHERE session_key = ? ORDER BY id", (session_key,)
+            ).fetchall()
+
+        # replay the log: a summary event folds the oldest buffered messages into the summary
+        summary = ""
+        buffer: List[BaseMessage] = []
+        for kind, text, pruned in rows:
+            if kind == "summary":
+                summary = text
+                buffer = buffer[pruned:]
+            elif kind == "human":
+                buffer.append(HumanMessage(content=text))
+            else:
+                buffer.append(AIMessage(content=text))
+
+        return summary, buffer
+
+    def memory_writer(self, session_key: str) -> SessionMemoryWriter:
+        return SessionMemoryWriter(self, session_key)
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+    def __write(self, sql: str, params: tuple):
+        with self.__lock:
+            self.__connection.execute(sql, params)
+            self.__connection.commit()
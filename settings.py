@@ -0,0 +1,79 @@
+from typing import Optional, Union
+from embedding_providers import EmbeddingProvider
+from indexer import CollectionSettings
+
+
+class CrawlSettings:
+    def __init__(self, max_pages: int = 0, workers: int = 1, checkpoint_path: str = None, cache_path: str = None,
+                 chunk_size: int = 1000, chunk_overlap: int = 20, split_workers: int = None,
+                 incremental: bool = False, per_host_limit: int = 4, delay: float = 0.0, timeout: float = 30.0):
+        self.max_pages = max_pages
+        self.workers = workers
+        # politeness: concurrent requests per host and seconds between them
+        self.per_host_limit = per_host_limit
+        self.delay = delay
+        self.timeout = timeout
+        self.checkpoint_path = checkpoint_path
+        self.cache_path = cache_path
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        # None picks one split process per core, up to four; they are only started for crawls of thousands of pages
+        self.split_workers = split_workers
+        # re-embed only new and changed pages instead of rebuilding the collection
+        self.incremental = incremental
+
+
+class EmbeddingSettings:
+    def __init__(self, provider: Union[str, EmbeddingProvider] = "openai", options: dict = None,
+                 cache_path: str = None, batch_size: int = 256, concurrency: int = 4):
+        self.provider = provider
+        self.options = options
+        self.cache_path = cache_path
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+
+
+class RetrievalSettings:
+    def __init__(self, mode: str = "vector", fetch_k: int = 20, k: int = 8, diversity: float = 0.5,
+                 duplicate_threshold: float = 0.8, context_token_budget: int = None):
+        # vector, lexical, hybrid, or auto (lexical for keyword-style queries, hybrid otherwise)
+        self.mode = mode
+        self.fetch_k = fetch_k
+        self.k = k
+        self.diversity = diversity
+        self.duplicate_threshold = duplicate_threshold
+        # None uses the model's context window
+        self.context_token_budget = context_token_budget
+
+    @property
+    def lexical_index(self) -> bool:
+        return self.mode != "vector"
+
+
+class StoreSettings:
+    def __init__(self, vector_store: str = "qdrant", server_url: str = None, server_options: dict = None,
+                 collection: CollectionSettings = None, upsert_workers: int = 4, upsert_batch_size: int = 64):
+        # embedded qdrant, a qdrant server or the memory-mapped numpy store
+        self.vector_store = vector_store
+        self.server_url = server_url
+        self.server_options = server_options
+        self.collection = collection
+        self.upsert_workers = upsert_workers
+        self.upsert_batch_size = upsert_batch_size
+
+    def collection_settings(self) -> Optional[CollectionSettings]:
+        # a server gets tuned collections unless told otherwise
+        if self.collection is None and self.vector_store == "qdrant-server":
+            return CollectionSettings()
+        return self.collection
+
+    def parallel_upserts(self) -> int:
+        # the embedded client is not meant for concurrent writers
+        return self.upsert_workers if self.vector_store == "qdrant-server" else 1
+
+
+class AnswerCacheSettings:
+    def __init__(self, threshold: float = 0.95, ttl: float = 3600.0, capacity: int = 256):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.capacity = capacity
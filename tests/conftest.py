@@ -0,0 +1,23 @@
+import os
+import sys
+import pytest
+from langchain.schema import Document
+
+# the modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scraper import Scraper  # noqa: E402
+
+PAGES = [Document(page_content="Page {}: the client retries requests and counts tokens per call.".format(i),
+                  metadata={"source": "http://docs.example.com/page/{}".format(i)})
+         for i in range(20)]
+
+
+@pytest.fixture
+def fake_crawl(monkeypatch):
+    # every crawl yields the same pages without touching the network
+    def crawl_iter(self):
+        yield from PAGES
+
+    monkeypatch.setattr(Scraper, "crawl_iter", crawl_iter)
+    return PAGES
@@ -0,0 +1,68 @@
+import functools
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from langchain.schema import Document
+from frontier import CrawlCheckpoint, CrawlFrontier, normalize_url
+from scraper import Scraper
+
+
+def test_normalize_url():
+    assert normalize_url("HTTP://Example.COM:80/docs/?b=2&a=1#intro") == "http://example.com/docs?a=1&b=2"
+    assert normalize_url("https://example.com:8443") == "https://example.com:8443/"
+    assert normalize_url("https://example.com/a/") == normalize_url("https://example.com/a")
+
+
+def test_frontier_skips_seen_urls():
+    frontier = CrawlFrontier()
+    assert frontier.push("http://example.com/a")
+    assert not frontier.push("http://example.com/a")
+    assert frontier.pop() == "http://example.com/a"
+    assert not frontier.push("http://example.com/a")
+    assert len(frontier) == 0
+
+
+def test_checkpoint_resume(tmp_path):
+    checkpoint = CrawlCheckpoint(str(tmp_path / "checkpoint"))
+    frontier = CrawlFrontier(["http://example.com/c"], ["http://example.com/a", "http://example.com/b"])
+    pages = [Document(page_content="page a", metadata={"source": "http://example.com/a"})]
+    checkpoint.save(frontier, ["http://example.com/b"], pages, 1)
+
+    # a page appended after the last frontier save is dropped on resume, its url is still queued
+    with open(str(tmp_path / "checkpoint" / "pages.jsonl"), "a", encoding="utf-8") as f:
+        f.write('{"page_content": "page b", "metadata": {"source": "http://example.com/b"}}\n')
+
+    assert checkpoint.exists()
+    resumed, page_count = checkpoint.load()
+    assert page_count == 1
+    assert resumed.queue == ["http://example.com/b", "http://example.com/c"]
+    assert "http://example.com/a" in resumed
+    assert [doc.page_content for doc in checkpoint.pages()] == ["page a"]
+
+    checkpoint.clear()
+    assert not checkpoint.exists()
+
+
+def test_frontier_keeps_the_linked_url():
+    frontier = CrawlFrontier()
+    assert frontier.push("http://example.com/guide/")
+    assert not frontier.push("http://Example.com/guide")
+    assert "http://example.com/guide" in frontier
+    assert frontier.pop() == "http://example.com/guide/"
+
+
+def test_relative_links_resolve_against_directory_urls(tmp_path):
+    (tmp_path / "guide").mkdir()
+    (tmp_path / "guide" / "index.html").write_text('<main><p>Guide</p><a href="intro.html">Intro</a></main>')
+    (tmp_path / "guide" / "intro.html").write_text("<main><p>Intro</p></main>")
+    handler = functools.partial(SimpleHTTPRequestHandler, directory=str(tmp_path))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        # /guide redirects to /guide/, and intro.html lives next to the index
+        pages = list(Scraper("http://127.0.0.1:{}/guide".format(server.server_port)).crawl_iter())
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert sorted(page.page_content for page in pages) == ["Guide\nIntro", "Intro"]
+    assert pages[-1].metadata["source"].endswith("/guide/intro.html")
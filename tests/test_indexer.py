@@ -0,0 +1,70 @@
+import os
+from langchain.schema import Document
+from embedding_providers import HashingEmbeddingProvider
+from indexer import IncrementalIndexer
+from vector_store import NumpyVectorClient
+
+
+def pages(*sources, version=""):
+    return [Document(page_content="chunk {} of {}{}".format(i, source, version), metadata={"source": source})
+            for source in sources for i in range(3)]
+
+
+def indexer(tmp_path, client):
+    return IncrementalIndexer(client, "docs", HashingEmbeddingProvider(dimension=32),
+                              manifest_path=os.path.join(str(tmp_path), "docs.manifest.json"))
+
+
+def test_reindex_only_embeds_changes(tmp_path):
+    client = NumpyVectorClient(str(tmp_path / "vectors"))
+    stats = indexer(tmp_path, client).index(pages("a", "b"))
+    assert (stats.added, stats.removed, stats.unchanged) == (6, 0, 0)
+
+    stats = indexer(tmp_path, client).index(pages("a") + pages("c"))
+    assert (stats.added, stats.removed, stats.unchanged) == (3, 3, 3)
+    assert client.count("docs").count == 6
+
+
+def test_crawl_keeps_only_sources_that_failed_to_load(tmp_path):
+    client = NumpyVectorClient(str(tmp_path / "vectors"))
+    indexer(tmp_path, client).index(pages("a", "b", "c"))
+
+    # b failed to load this time, c is no longer linked from anywhere and was never fetched
+    docs_indexer = indexer(tmp_path, client)
+    docs_indexer.begin()
+    docs_indexer.add(pages("a", version=" v2"))
+    stats = docs_indexer.finish(kept_sources={"b"})
+    assert (stats.added, stats.removed) == (3, 6)
+    assert client.count("docs").count == 6
+
+    # a crawl that saw nothing changes nothing
+    docs_indexer = indexer(tmp_path, client)
+    docs_indexer.begin()
+    stats = docs_indexer.finish()
+    assert stats.removed == 0
+    assert client.count("docs").count == 6
+
+    # a crawl cut short by max_pages keeps every page it did not get to
+    docs_indexer = indexer(tmp_path, client)
+    docs_indexer.begin()
+    docs_indexer.add(pages("a", version=" v2"))
+    stats = docs_indexer.finish(keep_unseen=True)
+    assert (stats.unchanged, stats.removed) == (3, 0)
+
+    docs_indexer = indexer(tmp_path, client)
+    docs_indexer.begin()
+    docs_indexer.add(pages("a", version=" v2"))
+    stats = docs_indexer.finish()
+    assert (stats.unchanged, stats.removed) == (3, 3)
+    assert client.count("docs").count == 3
+
+
+def test_failed_rebuild_keeps_existing_collection(tmp_path):
+    client = NumpyVectorClient(str(tmp_path / "vectors"))
+    indexer(tmp_path, client).index(pages("a", "b"))
+
+    docs_indexer = indexer(tmp_path, client)
+    docs_indexer.begin(rebuild=True)
+    docs_indexer.abort()
+    assert client.count("docs").count == 6
+    assert indexer(tmp_path, client).index(pages("a", "b")).unchanged == 6
@@ -0,0 +1,93 @@
+import pytest
+import qdrant_client
+from answer_cache import AnswerCache
+from knowledge_base import EmbeddingMismatchError, KnowledgeBase, KnowledgeBaseRegistry
+from scraper import Scraper
+from settings import CrawlSettings, EmbeddingSettings, StoreSettings
+from vector_store import NumpyVectorClient
+
+URL = "http://docs.example.com/index.html"
+
+
+def knowledge_base(path, client, dimension):
+    return KnowledgeBase("sk-test", URL, path, "docs", client, crawl=CrawlSettings(split_workers=1),
+                         embedding=EmbeddingSettings(provider="hashing", options={"dimension": dimension}))
+
+
+def test_reopen_with_another_embedding_fails(tmp_path, fake_crawl):
+    client = NumpyVectorClient(str(tmp_path / "vectors"))
+    knowledge_base(str(tmp_path), client, 32).load(True).close()
+
+    knowledge_base(str(tmp_path), client, 32).load().close()
+    with pytest.raises(EmbeddingMismatchError):
+        knowledge_base(str(tmp_path), client, 64).load()
+
+
+def test_embedding_record_is_kept_in_the_store(tmp_path, fake_crawl):
+    # two hosts share the vector store but not their local database folders
+    client = NumpyVectorClient(str(tmp_path / "vectors"))
+    knowledge_base(str(tmp_path / "first"), client, 32).load(True).close()
+
+    knowledge_base(str(tmp_path / "second"), client, 32).load().close()
+    # same dimension, another model: only the stored record tells them apart
+    with pytest.raises(EmbeddingMismatchError):
+        KnowledgeBase("sk-test", URL, str(tmp_path / "third"), "docs", client, crawl=CrawlSettings(split_workers=1),
+                      embedding=EmbeddingSettings(provider="hashing",
+                                                  options={"dimension": 32, "ngram_range": (1, 1)})).load()
+
+def test_crawl_settings_reach_the_scraper(tmp_path, monkeypatch):
+    seen = []
+
+    def crawl_iter(self):
+        seen.append((self._Scraper__per_host_limit, self._Scraper__delay, self._Scraper__timeout))
+        yield from ()
+    monkeypatch.setattr(Scraper, "crawl_iter", crawl_iter)
+
+    crawl = CrawlSettings(split_workers=1, per_host_limit=1, delay=0.5, timeout=5.0)
+    KnowledgeBase("sk-test", URL, str(tmp_path), "docs", NumpyVectorClient(str(tmp_path / "vectors")), crawl=crawl,
+                  embedding=EmbeddingSettings(provider="hashing")).load(True).close()
+    assert seen == [(1, 0.5, 5.0)]
+
+def test_registry_closes_clients_and_keys_by_store(tmp_path, fake_crawl):
+    registry = KnowledgeBaseRegistry()
+
+    def open_docs(db_path, lexical_index=False):
+        def factory(client):
+            return KnowledgeBase("sk-test", URL, db_path, "docs", client, crawl=CrawlSettings(split_workers=1),
+                                 embedding=EmbeddingSettings(provider="hashing"), lexical_index=lexical_index).load()
+        return registry.acquire(URL, db_path, "docs", factory, store=StoreSettings(vector_store="qdrant"),
+                                lexical_index=lexical_index)
+
+    first = open_docs(str(tmp_path / "first"))
+    second = open_docs(str(tmp_path / "second"))
+    assert first is not second
+    assert open_docs(str(tmp_path / "first")) is first
+    with pytest.raises(ValueError):
+        open_docs(str(tmp_path / "first"), lexical_index=True)
+
+    registry.release(first)
+    registry.release(first)
+    registry.release(second)
+    assert len(registry) == 0
+
+    # the embedded client's folder lock is gone, so the folder can be opened again
+    client = qdrant_client.QdrantClient(path=str(tmp_path / "first"))
+    assert client.count("docs").count == len(fake_crawl)
+
+
+def test_answer_caches_are_kept_per_configuration(tmp_path, fake_crawl):
+    docs = knowledge_base(str(tmp_path), NumpyVectorClient(str(tmp_path / "vectors")), 32).load()
+    warm = docs.answer_cache(("gpt-3.5-turbo", 0.7), AnswerCache)
+    cold = docs.answer_cache(("gpt-3.5-turbo", 0.0), AnswerCache)
+    assert warm is not cold
+    assert docs.answer_cache(("gpt-3.5-turbo", 0.7), AnswerCache) is warm
+
+    vector = docs.embeddings.embed_query("How are retries counted?")
+    warm.put("How are retries counted?", vector, "per call")
+    assert warm.get(vector) == "per call"
+    assert cold.get(vector) is None
+
+    # a reload from source drops the answers of every configuration
+    docs.load(True)
+    assert warm.get(vector) is None
+    docs.close()
@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+from PyQt5.QtCore import QCoreApplication
+from PyQt5.QtTest import QTest
+from pychat import QueryScheduler
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+app = QCoreApplication.instance() or QCoreApplication([])
+
+
+class SlowEngine:
+    # ignores cancellation for a while, like a completion that has not streamed its first token yet
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.lock = threading.Lock()
+        self.overlapped = False
+        self.calls = []
+        self.closed_while_running = None
+
+    def query(self, message, on_token=None):
+        if not self.lock.acquire(blocking=False):
+            self.overlapped = True
+            self.lock.acquire()
+        try:
+            self.calls.append(message)
+            time.sleep(self.seconds)
+            on_token("token")
+            return message
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.closed_while_running = self.lock.locked()
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        QTest.qWait(10)
+    assert condition()
+
+
+def test_timed_out_request_holds_the_engine_until_it_returns():
+    scheduler = QueryScheduler(timeout_ms=50)
+    engine = SlowEngine(0.3)
+    failed, finished = [], []
+    scheduler.failed.connect(lambda key, request_id, error: failed.append(error))
+    scheduler.finished.connect(lambda key, request_id, response: finished.append(response))
+
+    scheduler.submit("notes", engine, "first")
+    scheduler.submit("notes", engine, "second")
+    wait_until(lambda: len(engine.calls) == 2)
+    assert failed[0] == "Timed out"
+    assert not engine.overlapped
+    scheduler.shutdown()
+
+
+def test_engine_closes_after_the_cancelled_request_returns():
+    scheduler = QueryScheduler()
+    engine = SlowEngine(0.2)
+    scheduler.submit("notes", engine, "first")
+    wait_until(lambda: engine.calls)
+
+    scheduler.cancel("notes", engine.close)
+    assert engine.closed_while_running is None
+    wait_until(lambda: engine.closed_while_running is not None)
+    assert engine.closed_while_running is False
+    assert not scheduler.is_busy("notes")
+    scheduler.shutdown()
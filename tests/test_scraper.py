@@ -0,0 +1,19 @@
+from scraper import extract_page
+
+
+def test_layout_inside_the_article_is_kept():
+    page = b"""<html><body>
+    <header><a href="/">Home</a> Site menu</header>
+    <article><header><h1>Install guide</h1></header><p>Run pip install.</p><footer>Updated today</footer></article>
+    <aside><article><p>Related post</p></article></aside>
+    <footer>Copyright</footer><script>track()</script>
+    </body></html>"""
+    links, text = extract_page(page)
+    assert links == ["/"]
+    assert text == "Install guide\nRun pip install.\nUpdated today"
+
+
+def test_layout_is_stripped_from_the_body_fallback():
+    page = b"""<html><body><nav>Docs Blog</nav><h1>Changelog</h1><p>Fixed retries.</p>
+    <form><input name="q"> Search</form><footer>Copyright</footer></body></html>"""
+    assert extract_page(page)[1] == "Changelog\nFixed retries."
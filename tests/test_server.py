@@ -0,0 +1,100 @@
+import asyncio
+import threading
+from ai import OpenAIChat
+from benchmark import FakeLLM
+from server import TOKEN_BUFFER, ChatService
+from session_store import SessionStore
+
+
+class SlowEngine(OpenAIChat):
+    # streams tokens until it is told to stop, so a reply can be caught while it runs
+    def __init__(self):
+        super().__init__("gpt-3.5-turbo", "sk-test", llm_factory=FakeLLM)
+        self.started = threading.Event()
+        self.running = False
+        self.closed_while_running = False
+
+    def query(self, query, on_token=None) -> str:
+        self.running = True
+        self.started.set()
+        try:
+            for _ in range(500):
+                on_token("token ")
+                threading.Event().wait(0.01)
+            return "done"
+        finally:
+            self.running = False
+
+    def close(self):
+        self.closed_while_running = self.running
+
+
+def test_sessions_are_listed_per_user(tmp_path):
+    async def run():
+        service = ChatService(SlowEngine, SessionStore(str(tmp_path / "server.sqlite")))
+        await service.create_session("a", "notes")
+        await service.create_session("a/b", "secrets")
+        await service.create_session("a%2Fb", "other")
+        assert service.list_sessions("a") == ["notes"]
+        assert service.list_sessions("a/b") == ["secrets"]
+        service.close()
+
+    asyncio.run(run())
+
+
+def test_remove_session_waits_for_the_running_reply(tmp_path):
+    engines = []
+
+    def engine_factory():
+        engines.append(SlowEngine())
+        return engines[-1]
+
+    async def run():
+        service = ChatService(engine_factory, SessionStore(str(tmp_path / "server.sqlite")))
+
+        async def reply():
+            return [event async for event in service.reply("a", "notes", "hello")]
+
+        running = asyncio.ensure_future(reply())
+        queued = asyncio.ensure_future(reply())
+        while not engines or not engines[0].started.is_set():
+            await asyncio.sleep(0.01)
+        await service.remove_session("a", "notes")
+
+        # the running reply is cancelled, the queued one never reaches the closed engine
+        assert not engines[0].closed_while_running
+        assert not any(event["type"] == "done" for event in await running)
+        assert [event["type"] for event in await queued] == ["error"]
+        assert service.list_sessions("a") == []
+        service.close()
+
+    asyncio.run(run())
+
+
+def test_a_slow_client_holds_the_engine_back(tmp_path):
+    class FastEngine(SlowEngine):
+        def query(self, query, on_token=None) -> str:
+            self.sent = 0
+            for _ in range(500):
+                on_token("token ")
+                self.sent += 1
+            return "done"
+
+    engines = []
+
+    def engine_factory():
+        engines.append(FastEngine())
+        return engines[-1]
+
+    async def run():
+        service = ChatService(engine_factory, SessionStore(str(tmp_path / "server.sqlite")))
+        events = service.reply("a", "notes", "hello")
+        await events.__anext__()
+        await asyncio.sleep(0.3)
+        # the engine waits for the client instead of buffering the whole reply
+        assert engines[0].sent <= TOKEN_BUFFER + 2
+        assert [event["type"] async for event in events][-1] == "done"
+        assert engines[0].sent == 500
+        service.close()
+
+    asyncio.run(run())
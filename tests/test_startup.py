@@ -0,0 +1,40 @@
+import time
+import pytest
+from ai import OpenAISitemapWebSearch
+from benchmark import FakeLLM
+from knowledge_base import KnowledgeBaseRegistry
+from scraper import Scraper
+from settings import CrawlSettings, EmbeddingSettings, RetrievalSettings, StoreSettings
+
+URL = "http://docs.example.com/index.html"
+# reopening an indexed collection reads no pages, it only checks the embedding record
+REOPEN_SECONDS = 1.0
+
+
+def fail_crawl(self):
+    raise AssertionError("an indexed collection was crawled again")
+
+
+def engine(db_path, vector_store, load_docs_from_source=False):
+    return OpenAISitemapWebSearch(
+        model_name="gpt-3.5-turbo", api_key="sk-test", url=URL, db_path=db_path, collection_name="docs",
+        load_docs_from_source=load_docs_from_source, crawl=CrawlSettings(split_workers=1),
+        embedding=EmbeddingSettings(provider="hashing"), retrieval=RetrievalSettings(mode="auto"),
+        store=StoreSettings(vector_store=vector_store), registry=KnowledgeBaseRegistry(), llm_factory=FakeLLM
+    )
+
+
+@pytest.mark.parametrize("vector_store", ["qdrant", "numpy"])
+def test_reopen_does_not_crawl(tmp_path, monkeypatch, fake_crawl, vector_store):
+    engine(str(tmp_path), vector_store, load_docs_from_source=True).close()
+
+    monkeypatch.setattr(Scraper, "crawl_iter", fail_crawl)
+    start = time.perf_counter()
+    reopened = engine(str(tmp_path), vector_store)
+    elapsed = time.perf_counter() - start
+    try:
+        assert elapsed < REOPEN_SECONDS
+        assert reopened.knowledge_base.client.count("docs").count == len(fake_crawl)
+        assert reopened.query("How does the client retry requests?")
+    finally:
+        reopened.close()
@@ -0,0 +1,58 @@
+import os
+import numpy as np
+from qdrant_client.http import models
+from vector_store import NumpyVectorClient
+
+
+def points(start, count, dimension=8):
+    rng = np.random.default_rng(start)
+    return [models.PointStruct(id="p{}".format(i), vector=rng.standard_normal(dimension).tolist(),
+                               payload={"page_content": "point {}".format(i)})
+            for i in range(start, start + count)]
+
+
+def create(path):
+    client = NumpyVectorClient(path)
+    client.recreate_collection("docs", vectors_config=models.VectorParams(size=8, distance=models.Distance.COSINE))
+    return client
+
+
+def test_upsert_replaces_points(tmp_path):
+    client = create(str(tmp_path))
+    client.upsert("docs", points=points(0, 10))
+    replacement = points(0, 1)[0]
+    replacement.payload = {"page_content": "replaced"}
+    client.upsert("docs", points=[replacement])
+
+    assert client.count("docs").count == 10
+    hit = client.search("docs", query_vector=replacement.vector, limit=1)[0]
+    assert hit.id == "p0"
+    assert hit.payload["page_content"] == "replaced"
+    assert abs(hit.score - 1.0) < 1e-5
+
+
+def test_delete_and_compaction(tmp_path):
+    client = create(str(tmp_path))
+    inserted = points(0, 1500)
+    client.upsert("docs", points=inserted)
+    client.delete("docs", points_selector=models.PointIdsList(points=["p{}".format(i) for i in range(100)]))
+    assert client.count("docs").count == 1400
+    assert [record.id for record in client.retrieve("docs", ids=["p0", "p100"])] == ["p100"]
+
+    # deleting more than half the rows copies the live ones into a new generation
+    client.delete("docs", points_selector=models.PointIdsList(points=["p{}".format(i) for i in range(100, 1100)]))
+    # the previous generation is kept for readers in other processes that read meta.json just before
+    files = os.listdir(str(tmp_path / "docs.npvec"))
+    assert "vectors.1.f32" in files and "vectors.0.f32" in files
+
+    # a second client sees the compacted collection
+    reader = NumpyVectorClient(str(tmp_path))
+    assert reader.count("docs").count == 400
+    assert reader.search("docs", query_vector=inserted[1200].vector, limit=1)[0].id == "p1200"
+
+    # the next compaction removes the generation before the previous one
+    client.upsert("docs", points=points(2000, 1200))
+    client.delete("docs", points_selector=models.PointIdsList(points=["p{}".format(i) for i in range(2000, 3100)]))
+    files = os.listdir(str(tmp_path / "docs.npvec"))
+    assert "vectors.2.f32" in files and "vectors.1.f32" in files and "vectors.0.f32" not in files
+    assert reader.count("docs").count == 500
@@ -0,0 +1,182 @@
+import json
+import time
+import threading
+from typing import Any, Dict, Tuple
+
+# upper bounds, in seconds, of the span duration histogram buckets
+SPAN_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class TraceListener:
+    def span_finished(self, name: str, seconds: float, attributes: Dict[str, Any]):
+        pass
+
+    def counter_added(self, name: str, value: float):
+        pass
+
+
+class Span:
+    def __init__(self, tracer: "Tracer", name: str, attributes: Dict[str, Any]):
+        self.__tracer = tracer
+        self.__name = name
+        self.__start = 0.0
+        self.attributes = attributes
+
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def __enter__(self) -> "Span":
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self.__tracer.record(self.__name, time.perf_counter() - self.__start, self.attributes)
+        return False
+
+
+class NullSpan:
+    def set(self, key: str, value: Any):
+        pass
+
+    def __enter__(self) -> "NullSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # replaced rather than mutated, so the hot paths read it without taking the lock
+        self.__listeners: Tuple[TraceListener, ...] = ()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.__listeners)
+
+    def add_listener(self, listener: TraceListener):
+        with self.__lock:
+            self.__listeners = self.__listeners + (listener,)
+
+    def remove_listener(self, listener: TraceListener):
+        with self.__lock:
+            self.__listeners = tuple(known for known in self.__listeners if known is not listener)
+
+    def span(self, name: str, **attributes):
+        # without listeners nothing is timed; every caller shares one do-nothing span
+        if not self.__listeners:
+            return NULL_SPAN
+        return Span(self, name, attributes)
+
+    def record(self, name: str, seconds: float, attributes: Dict[str, Any] = None):
+        for listener in self.__listeners:
+            try:
+                listener.span_finished(name, seconds, attributes or {})
+            except Exception as error:
+                print(error)
+
+    def count(self, name: str, value: float = 1):
+        for listener in self.__listeners:
+            try:
+                listener.counter_added(name, value)
+            except Exception as error:
+                print(error)
+
+
+tracer = Tracer()
+
+
+class SpanStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(SPAN_BUCKETS)
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for index, bound in enumerate(SPAN_BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+
+
+class MetricsCollector(TraceListener):
+    def __init__(self, namespace: str = "pychat"):
+        self.__namespace = namespace
+        self.__lock = threading.Lock()
+        self.__spans: Dict[str, SpanStats] = {}
+        self.__counters: Dict[str, float] = {}
+
+    def span_finished(self, name: str, seconds: float, attributes: Dict[str, Any]):
+        # attributes are left to other listeners, aggregating by them would explode the series count
+        with self.__lock:
+            stats = self.__spans.get(name)
+            if stats is None:
+                stats = self.__spans[name] = SpanStats()
+            stats.add(seconds)
+
+    def counter_added(self, name: str, value: float):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def reset(self):
+        with self.__lock:
+            self.__spans.clear()
+            self.__counters.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.__lock:
+            spans = {
+                name: {
+                    "count": stats.count,
+                    "total_seconds": round(stats.total, 6),
+                    "mean_ms": round(stats.total / stats.count * 1000, 3),
+                    "max_ms": round(stats.max * 1000, 3),
+                }
+                for name, stats in sorted(self.__spans.items())
+            }
+            counters = dict(sorted(self.__counters.items()))
+
+        # caches count "<cache>.hits" and "<cache>.misses"
+        hit_rates = {}
+        for name, hits in counters.items():
+            if name.endswith(".hits"):
+                cache = name[:-len(".hits")]
+                lookups = hits + counters.get(cache + ".misses", 0)
+                hit_rates[cache] = round(hits / lookups, 4) if lookups else 0.0
+        return {"spans": spans, "counters": counters, "cache_hit_rates": hit_rates}
+
+    def json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def prometheus(self) -> str:
+        lines = []
+        with self.__lock:
+            for name, stats in sorted(self.__spans.items()):
+                metric = self.__metric_name(name) + "_seconds"
+                lines.append("# TYPE {} histogram".format(metric))
+                cumulative = 0
+                for bound, count in zip(SPAN_BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(metric, bound, cumulative))
+                lines.append('{}_bucket{{le="+Inf"}} {}'.format(metric, stats.count))
+                lines.append("{}_sum {}".format(metric, stats.total))
+                lines.append("{}_count {}".format(metric, stats.count))
+
+            for name, value in sorted(self.__counters.items()):
+                metric = self.__metric_name(name) + "_total"
+                lines.append("# TYPE {} counter".format(metric))
+                lines.append("{} {}".format(metric, value))
+        return "\n".join(lines) + "\n"
+
+    def __metric_name(self, name: str) -> str:
+        return "{}_{}".format(self.__namespace, name.replace(".", "_").replace("-", "_"))
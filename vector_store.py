@@ -0,0 +1,340 @@
+import os
+import json
+import shutil
+import threading
+import numpy as np
+from typing import Dict, List, Optional, Sequence, Tuple
+from qdrant_client.http import models
+
+
+class VectorsConfig:
+    def __init__(self, vectors: models.VectorParams):
+        self.params = self
+        self.vectors = vectors
+
+
+class NumpyCollectionInfo:
+    def __init__(self, vectors: models.VectorParams, points_count: int):
+        self.config = VectorsConfig(vectors)
+        self.points_count = points_count
+        self.vectors_count = points_count
+
+
+class CollectionSnapshot:
+    def __init__(self, meta: Dict, matrix: np.ndarray, ids: List[str], payloads: List[dict]):
+        self.meta = meta
+        self.matrix = matrix
+        self.ids = ids
+        self.payloads = payloads
+
+        deleted = set(meta["deleted"])
+        self.live = np.ones(meta["rows"], dtype=bool)
+        if deleted:
+            self.live[list(deleted)] = False
+        self.rows_by_id = {ids[row]: row for row in range(meta["rows"]) if row not in deleted}
+
+    def point(self, row: int, with_payload: bool, with_vectors: bool) -> Tuple[str, Optional[dict], Optional[list]]:
+        return (self.ids[row], self.payloads[row] if with_payload else None,
+                self.matrix[row].tolist() if with_vectors else None)
+
+
+class NumpyCollection:
+    # vectors.<generation>.f32 is an append-only float32 matrix and payloads.<generation>.jsonl holds one
+    # {"id", "payload"} line per row. meta.json is replaced atomically after every write, so readers only
+    # ever see complete rows and never take a file lock; a single writer per collection is assumed.
+    def __init__(self, path: str):
+        self.__path = path
+        self.__write_lock = threading.Lock()
+        self.__refresh_lock = threading.Lock()
+        self.__stamp = None
+        self.__snapshot: Optional[CollectionSnapshot] = None
+        self.__ids: List[str] = []
+        self.__payloads: List[dict] = []
+        self.__payload_offset = 0
+        self.__payload_generation = None
+
+    @staticmethod
+    def create(path: str, dimension: int, distance: str) -> "NumpyCollection":
+        os.makedirs(path, exist_ok=True)
+        collection = NumpyCollection(path)
+        open(collection.__vectors_path(0), "wb").close()
+        open(collection.__payloads_path(0), "wb").close()
+        collection.__write_meta({"dimension": dimension, "distance": distance, "generation": 0, "rows": 0,
+                                 "payload_bytes": 0, "deleted": []})
+        return collection
+
+    @property
+    def dimension(self) -> int:
+        return self.snapshot().meta["dimension"]
+
+    @property
+    def distance(self) -> str:
+        return self.snapshot().meta["distance"]
+
+    def count(self) -> int:
+        return len(self.snapshot().rows_by_id)
+
+    def snapshot(self) -> CollectionSnapshot:
+        # one stat per call; the files are only re-read after a writer replaced meta.json
+        stamp = self.__meta_stamp()
+        if stamp == self.__stamp:
+            return self.__snapshot
+
+        with self.__refresh_lock:
+            if stamp != self.__stamp:
+                try:
+                    self.__snapshot = self.__load()
+                except FileNotFoundError:
+                    # a writer in another process compacted twice since meta.json was read; its new one is complete
+                    stamp = self.__meta_stamp()
+                    self.__snapshot = self.__load()
+                self.__stamp = stamp
+            return self.__snapshot
+
+    def __meta_stamp(self) -> tuple:
+        stat = os.stat(self.__meta_path())
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def __load(self) -> CollectionSnapshot:
+        with open(self.__meta_path(), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        generation, rows, dimension = meta["generation"], meta["rows"], meta["dimension"]
+
+        # a new generation gets new lists, so older snapshots keep consistent row numbers
+        if generation != self.__payload_generation:
+            self.__ids, self.__payloads, self.__payload_offset = [], [], 0
+            self.__payload_generation = generation
+
+        # only the payload lines appended since the last load are parsed
+        if len(self.__ids) < rows:
+            with open(self.__payloads_path(generation), "rb") as f:
+                f.seek(self.__payload_offset)
+                while len(self.__ids) < rows:
+                    entry = json.loads(f.readline())
+                    self.__ids.append(entry["id"])
+                    self.__payloads.append(entry["payload"])
+                self.__payload_offset = f.tell()
+
+        if rows:
+            matrix = np.memmap(self.__vectors_path(generation), dtype=np.float32, mode="r", shape=(rows, dimension))
+        else:
+            matrix = np.zeros((0, dimension), dtype=np.float32)
+        return CollectionSnapshot(meta, matrix, self.__ids, self.__payloads)
+
+    def search(self, snapshot: CollectionSnapshot, vectors: np.ndarray, limit: int) -> List[List[Tuple[int, float]]]:
+        matrix, live, distance = snapshot.matrix, snapshot.live, snapshot.meta["distance"]
+        limit = min(limit, int(live.sum()))
+        if limit == 0:
+            return [[] for _ in vectors]
+
+        # brute force over the mapped matrix, one product for the whole batch of queries
+        if distance == models.Distance.COSINE.value:
+            vectors = self.normalize(vectors)
+        if distance == models.Distance.EUCLID.value:
+            # |q - m|^2 = |q|^2 + |m|^2 - 2 q.m, without a queries x rows x dimension temporary
+            squared = (np.einsum("ij,ij->i", vectors, vectors)[:, None] + np.einsum("ij,ij->i", matrix, matrix)[None, :]
+                       - 2 * (vectors @ matrix.T))
+            scores = -np.sqrt(np.maximum(squared, 0))
+        else:
+            scores = vectors @ matrix.T
+        scores[:, ~live] = -np.inf
+
+        results = []
+        for row_scores in scores:
+            top = np.argpartition(-row_scores, limit - 1)[:limit]
+            top = top[np.argsort(-row_scores[top])]
+            results.append([(int(row), float(row_scores[row])) for row in top])
+        return results
+
+    def upsert(self, points: List[Tuple[str, List[float], dict]]):
+        with self.__write_lock:
+            snapshot = self.snapshot()
+            meta = dict(snapshot.meta)
+            deleted = set(meta["deleted"])
+            for point_id, _, _ in points:
+                if point_id in snapshot.rows_by_id:
+                    deleted.add(snapshot.rows_by_id[point_id])
+
+            vectors = np.asarray([vector for _, vector, _ in points], dtype=np.float32)
+            if meta["distance"] == models.Distance.COSINE.value:
+                vectors = self.normalize(vectors)
+
+            # anything past the sizes recorded in meta.json is left over from an interrupted write
+            with open(self.__vectors_path(meta["generation"]), "r+b") as f:
+                f.truncate(meta["rows"] * meta["dimension"] * 4)
+                f.seek(0, os.SEEK_END)
+                f.write(vectors.tobytes())
+            with open(self.__payloads_path(meta["generation"]), "r+b") as f:
+                f.truncate(meta["payload_bytes"])
+                f.seek(0, os.SEEK_END)
+                for point_id, _, payload in points:
+                    f.write((json.dumps({"id": point_id, "payload": payload}) + "\n").encode("utf-8"))
+                meta["payload_bytes"] = f.tell()
+
+            meta["rows"] += len(points)
+            meta["deleted"] = sorted(deleted)
+            self.__write_meta(meta)
+            self.__compact_if_needed()
+
+    def delete(self, point_ids: Sequence[str]):
+        with self.__write_lock:
+            snapshot = self.snapshot()
+            meta = dict(snapshot.meta)
+            deleted = set(meta["deleted"])
+            deleted.update(snapshot.rows_by_id[point_id] for point_id in point_ids if point_id in snapshot.rows_by_id)
+            meta["deleted"] = sorted(deleted)
+            self.__write_meta(meta)
+            self.__compact_if_needed()
+
+    def __compact_if_needed(self):
+        snapshot = self.snapshot()
+        meta = snapshot.meta
+        if len(meta["deleted"]) < 1024 or len(meta["deleted"]) * 2 < meta["rows"]:
+            return
+
+        # live rows are copied into a new generation; readers of the old files keep their mappings, and the previous
+        # generation stays on disk until the next compaction for readers that read meta.json just before this one
+        rows = sorted(snapshot.rows_by_id.values())
+        generation = meta["generation"] + 1
+        with open(self.__vectors_path(generation), "wb") as f:
+            f.write(np.ascontiguousarray(snapshot.matrix[rows]).tobytes())
+        with open(self.__payloads_path(generation), "wb") as f:
+            for row in rows:
+                f.write((json.dumps({"id": snapshot.ids[row], "payload": snapshot.payloads[row]}) + "\n").encode("utf-8"))
+            payload_bytes = f.tell()
+
+        self.__write_meta(dict(meta, generation=generation, rows=len(rows), payload_bytes=payload_bytes, deleted=[]))
+        expired_generation = generation - 2
+        for path in (self.__vectors_path(expired_generation), self.__payloads_path(expired_generation)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as error:
+                print(error)
+
+    def __write_meta(self, meta: Dict):
+        tmp_file = self.__meta_path() + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_file, self.__meta_path())
+
+    def __meta_path(self) -> str:
+        return os.path.join(self.__path, "meta.json")
+
+    def __vectors_path(self, generation: int) -> str:
+        return os.path.join(self.__path, "vectors.{}.f32".format(generation))
+
+    def __payloads_path(self, generation: int) -> str:
+        return os.path.join(self.__path, "payloads.{}.jsonl".format(generation))
+
+    @staticmethod
+    def normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1.0)
+
+
+class NumpyVectorClient:
+    # the subset of the QdrantClient api used by the indexer and the knowledge base, backed by NumpyCollection
+    def __init__(self, path: str):
+        self.__path = path
+        self.__lock = threading.Lock()
+        self.__collections: Dict[str, NumpyCollection] = {}
+        os.makedirs(path, exist_ok=True)
+
+    def get_collections(self) -> models.CollectionsResponse:
+        names = [name[:-len(".npvec")] for name in sorted(os.listdir(self.__path))
+                 if name.endswith(".npvec") and os.path.exists(os.path.join(self.__path, name, "meta.json"))]
+        return models.CollectionsResponse(collections=[models.CollectionDescription(name=name) for name in names])
+
+    def get_collection(self, collection_name: str) -> NumpyCollectionInfo:
+        collection = self.__collection(collection_name)
+        vectors = models.VectorParams(size=collection.dimension, distance=models.Distance(collection.distance))
+        return NumpyCollectionInfo(vectors, collection.count())
+
+    def recreate_collection(self, collection_name: str, vectors_config: models.VectorParams, **kwargs):
+        self.delete_collection(collection_name)
+        with self.__lock:
+            self.__collections[collection_name] = NumpyCollection.create(
+                self.__collection_path(collection_name), vectors_config.size, vectors_config.distance.value)
+
+    def delete_collection(self, collection_name: str, **kwargs):
+        with self.__lock:
+            self.__collections.pop(collection_name, None)
+            shutil.rmtree(self.__collection_path(collection_name), ignore_errors=True)
+
+    def create_payload_index(self, collection_name: str, field_name: str, **kwargs):
+        # payloads are scanned in memory, there is nothing to index
+        pass
+
+    def count(self, collection_name: str, exact: bool = True, **kwargs) -> models.CountResult:
+        return models.CountResult(count=self.__collection(collection_name).count())
+
+    def upsert(self, collection_name: str, points: List[models.PointStruct], **kwargs):
+        self.__collection(collection_name).upsert([(str(point.id), point.vector, point.payload) for point in points])
+
+    def delete(self, collection_name: str, points_selector: models.PointIdsList, **kwargs):
+        self.__collection(collection_name).delete([str(point_id) for point_id in points_selector.points])
+
+    def search(self, collection_name: str, query_vector: List[float], limit: int = 10, with_payload: bool = True,
+               with_vectors: bool = False, **kwargs) -> List[models.ScoredPoint]:
+        return self.search_batch(collection_name, [query_vector], limit, with_payload, with_vectors)[0]
+
+    def search_batch(self, collection_name: str, query_vectors: List[List[float]], limit: int = 10,
+                     with_payload: bool = True, with_vectors: bool = False) -> List[List[models.ScoredPoint]]:
+        collection = self.__collection(collection_name)
+        snapshot = collection.snapshot()
+        results = collection.search(snapshot, np.asarray(query_vectors, dtype=np.float32), limit)
+        return [
+            [self.__scored_point(snapshot, row, score, with_payload, with_vectors) for row, score in hits]
+            for hits in results
+        ]
+
+    def retrieve(self, collection_name: str, ids: Sequence[str], with_payload: bool = True,
+                 with_vectors: bool = False, **kwargs) -> List[models.Record]:
+        snapshot = self.__collection(collection_name).snapshot()
+        records = []
+        for point_id in ids:
+            row = snapshot.rows_by_id.get(str(point_id))
+            if row is not None:
+                records.append(self.__record(snapshot, row, with_payload, with_vectors))
+        return records
+
+    def scroll(self, collection_name: str, limit: int = 10, offset: Optional[int] = None,
+               with_payload: bool = True, with_vectors: bool = False, **kwargs) -> Tuple[List[models.Record], Optional[int]]:
+        snapshot = self.__collection(collection_name).snapshot()
+        rows = sorted(snapshot.rows_by_id.values())
+        start = offset or 0
+        page = rows[start:start + limit]
+        next_offset = start + limit if start + limit < len(rows) else None
+        return [self.__record(snapshot, row, with_payload, with_vectors) for row in page], next_offset
+
+    def close(self):
+        # the collections only hold memory maps, dropping them lets the files be removed or replaced
+        with self.__lock:
+            self.__collections.clear()
+
+    def __collection(self, collection_name: str) -> NumpyCollection:
+        with self.__lock:
+            collection = self.__collections.get(collection_name)
+            if collection is None:
+                path = self.__collection_path(collection_name)
+                if not os.path.exists(os.path.join(path, "meta.json")):
+                    raise ValueError("Collection {} not found".format(collection_name))
+                collection = NumpyCollection(path)
+                self.__collections[collection_name] = collection
+            return collection
+
+    def __collection_path(self, collection_name: str) -> str:
+        return os.path.join(self.__path, collection_name + ".npvec")
+
+    @staticmethod
+    def __scored_point(snapshot: CollectionSnapshot, row: int, score: float, with_payload: bool,
+                       with_vectors: bool) -> models.ScoredPoint:
+        point_id, payload, vector = snapshot.point(row, with_payload, with_vectors)
+        return models.ScoredPoint(id=point_id, version=0, score=score, payload=payload, vector=vector)
+
+    @staticmethod
+    def __record(snapshot: CollectionSnapshot, row: int, with_payload: bool, with_vectors: bool) -> models.Record:
+        point_id, payload, vector = snapshot.point(row, with_payload, with_vectors)
+        return models.Record(id=point_id, payload=payload, vector=vector)